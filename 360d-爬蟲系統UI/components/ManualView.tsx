@@ -2,14 +2,21 @@ import React, { useState, useEffect } from 'react';
 import { Mail, Play, Clock, Database, Search, ToggleLeft, ToggleRight, Trash2, FileText, Activity, X, ChevronRight } from 'lucide-react';
 import { API_BASE_URL } from '../config';
 
+// Columns the history list needs; the extracted items are fetched per entry
+const HISTORY_FIELDS = 'url,summary,status';
+const HISTORY_PAGE_SIZE = 10;
+
 interface HistoryItem {
   id: number;
   url: string;
-  topic: string;
+  topic?: string;
   summary: string;
-  data_json: string;
   timestamp: string;
   status: string;
+  // Only present on the detail endpoint (/api/history/{id})
+  data?: any[];
+  // Items changed since the previous run; null when nothing changed
+  delta?: { added: any[]; modified: any[]; removed: any[] } | null;
 }
 
 const ManualView: React.FC = () => {
@@ -21,6 +28,8 @@ const ManualView: React.FC = () => {
   const [loading, setLoading] = useState(false);
   const [history, setHistory] = useState<HistoryItem[]>([]);
   const [selectedHistory, setSelectedHistory] = useState<HistoryItem | null>(null);
+  // Keyset cursor for the next page (X-Next-Cursor); null once the end is reached
+  const [historyCursor, setHistoryCursor] = useState<string | null>(null);
 
   // Metrics
   const [lastTime, setLastTime] = useState<string | null>(null);
@@ -30,12 +39,28 @@ const ManualView: React.FC = () => {
     fetchHistory();
   }, []);
 
-  const fetchHistory = async () => {
+  const openHistoryDetail = async (item: HistoryItem) => {
+    // The list carries metadata only; load the extracted items on demand
+    setSelectedHistory(item);
     try {
-      const res = await fetch(`${API_BASE_URL}/api/history?limit=10`);
+      const res = await fetch(`${API_BASE_URL}/api/history/${item.id}`);
+      if (res.ok) {
+        setSelectedHistory(await res.json());
+      }
+    } catch (e) {
+      console.error("Failed to fetch history detail");
+    }
+  };
+
+  const fetchHistory = async (cursor: string | null = null) => {
+    try {
+      const params = new URLSearchParams({ limit: String(HISTORY_PAGE_SIZE), fields: HISTORY_FIELDS });
+      if (cursor) params.set('cursor', cursor);
+      const res = await fetch(`${API_BASE_URL}/api/history?${params}`);
       if (res.ok) {
         const data = await res.json();
-        setHistory(data);
+        setHistory(prev => (cursor ? [...prev, ...data] : data));
+        setHistoryCursor(res.headers.get('X-Next-Cursor'));
       }
     } catch (e) {
       console.error("Failed to fetch history");
@@ -52,7 +77,8 @@ const ManualView: React.FC = () => {
     setLastCount(null);
     const startTime = Date.now();
     try {
-      const response = await fetch(`${API_BASE_URL}/api/extract`, {
+      // Queue the extraction as a background job, then poll until it finishes
+      const response = await fetch(`${API_BASE_URL}/api/extract/jobs`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -60,19 +86,33 @@ const ManualView: React.FC = () => {
           email: email
         })
       });
-      // ...
+      const queued = await response.json();
+      if (!response.ok) {
+        alert(`失敗: ${queued.detail}`);
+        return;
+      }
+
+      let job = queued;
+      while (job.status !== 'succeeded' && job.status !== 'failed') {
+        await new Promise((resolve) => setTimeout(resolve, 1000));
+        const poll = await fetch(`${API_BASE_URL}${queued.status_url}`);
+        job = await poll.json();
+        if (!poll.ok) {
+          alert(`失敗: ${job.detail}`);
+          return;
+        }
+      }
 
       const endTime = Date.now();
       const duration = (endTime - startTime) / 1000;
       setLastTime(`${duration.toFixed(2)}s`);
 
-      const data = await response.json();
-      if (response.ok) {
-        setLastCount(data.count);
-        alert(`成功! 找到 ${data.count} 筆資料`);
+      if (job.status === 'succeeded') {
+        setLastCount(job.result.count);
+        alert(`成功! 找到 ${job.result.count} 筆資料`);
         fetchHistory(); // Refresh history
       } else {
-        alert(`失敗: ${data.detail}`);
+        alert(`失敗: ${job.error}`);
       }
     } catch (e) {
       alert('連線錯誤');
@@ -183,13 +223,13 @@ const ManualView: React.FC = () => {
         <div className="md:col-span-1 bg-slate-900/50 rounded-2xl border border-slate-800 p-5 flex flex-col">
           <div className="flex justify-between items-center mb-4">
             <span className="text-sm font-bold text-slate-400 uppercase tracking-wider">歷史紀錄</span>
-            <span className="text-xs text-slate-600 font-mono">最近 {history.length} 筆</span>
+            <span className="text-xs text-slate-600 font-mono">已載入 {history.length} 筆</span>
           </div>
           <div className="space-y-3 flex-1 overflow-y-auto pr-1 custom-scrollbar max-h-[300px]">
             {history.map((item) => (
               <div
                 key={item.id}
-                onClick={() => setSelectedHistory(item)}
+                onClick={() => openHistoryDetail(item)}
                 className="flex items-center justify-between p-2 rounded hover:bg-slate-800/80 transition-colors cursor-pointer group"
               >
                 <div className="flex items-center gap-2 overflow-hidden">
@@ -205,9 +245,17 @@ const ManualView: React.FC = () => {
             {history.length === 0 && (
               <div className="text-center text-slate-600 py-4 text-xs">暫無紀錄</div>
             )}
+            {historyCursor && (
+              <button
+                onClick={() => fetchHistory(historyCursor)}
+                className="w-full text-[10px] text-center text-slate-500 hover:text-slate-300 py-1"
+              >
+                載入更多
+              </button>
+            )}
           </div>
           <button
-            onClick={fetchHistory}
+            onClick={() => fetchHistory()}
             className="mt-3 w-full text-xs text-center text-slate-500 hover:text-slate-300 py-2 border-t border-slate-800"
           >
             重新整理
@@ -235,9 +283,14 @@ const ManualView: React.FC = () => {
                 </button>
               </div>
               <div className="p-4 overflow-auto custom-scrollbar flex-1 font-mono text-xs text-slate-300 bg-black/20">
-                <pre>{JSON.stringify(JSON.parse(selectedHistory.data_json || '[]'), null, 2)}</pre>
+                <pre>{selectedHistory.data ? JSON.stringify(selectedHistory.data, null, 2) : '載入中...'}</pre>
               </div>
-              <div className="p-3 border-t border-slate-800 flex justify-end">
+              <div className="p-3 border-t border-slate-800 flex justify-between">
+                <span className="text-xs text-slate-400">
+                  {selectedHistory.delta
+                    ? `新增 ${selectedHistory.delta.added.length} / 修改 ${selectedHistory.delta.modified.length} / 移除 ${selectedHistory.delta.removed.length}`
+                    : selectedHistory.delta === null ? '與上次相同' : ''}
+                </span>
                 <span className="text-xs text-slate-500">ID: {selectedHistory.id} | {selectedHistory.timestamp}</span>
               </div>
             </div>
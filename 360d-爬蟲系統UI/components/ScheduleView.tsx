@@ -7,7 +7,6 @@ interface HistoryItem {
   url: string;
   topic: string;
   summary: string;
-  data_json: string;
   timestamp: string;
   status: string;
 }
@@ -1,6 +1,10 @@
 import os
+import json
+import asyncio
+import time
 import uvicorn
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Any
@@ -8,6 +12,7 @@ from dotenv import load_dotenv
 
 # Import existing logic
 import database
+import metrics
 
 # Load environment variables
 load_dotenv(".env.local")
@@ -27,9 +32,31 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Pagination of /api/history and /api/search
+    expose_headers=["X-Next-Cursor", "X-Next-Offset"],
 )
 
-import scraper_css
+# Largest page /api/history serves; deeper history is reached through the cursor
+HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "200"))
+SEARCH_PAGE_MAX = int(os.getenv("SEARCH_PAGE_MAX", "100"))
+
+REQUEST_SECONDS = metrics.Histogram("http_request_seconds", "API request latency until response headers", ["method", "route", "status"])
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # Route templates (not raw paths) keep label cardinality bounded
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - start,
+        method=request.method, route=route.path if route else "unmatched", status=response.status_code,
+    )
+    return response
+
+import extraction
+import extract_jobs
+import export_history
 
 # --- Data Models ---
 class ExtractRequest(BaseModel):
@@ -50,6 +77,9 @@ class ScheduleRequest(BaseModel):
 @app.on_event("startup")
 def startup_event():
     database.init_db()
+    # Manual extractions queue their emails even when the scheduler is not started here
+    import outbox
+    outbox.start()
     
     # Start the background scheduler ONLY if strictly not reloader
     # When using uvicorn --reload, the main process sets RUN_MAIN=true
@@ -59,98 +89,47 @@ def startup_event():
     else:
         print("[Startup] Skipping scheduler start in reloader process")
 
+@app.on_event("shutdown")
+def shutdown_event():
+    import scheduler
+    scheduler.stop_scheduler()
+    # After the scheduler, so nothing queues new mail while the workers drain
+    import outbox
+    outbox.stop()
+    import mailer
+    mailer.close_smtp()
+
 @app.get("/")
 def read_root():
     return {"message": "360D Crawler API (CSS Only Mode) is running"}
 
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus scrape endpoint."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/outbox")
+def get_outbox():
+    """Outbound email counts per status and the latest dead-lettered messages."""
+    return {"counts": database.get_outbound_stats(), "dead": database.get_dead_outbound(limit=50)}
+
+@app.post("/api/outbox/{message_id}/retry")
+def retry_outbox_message(message_id: int):
+    """Re-queues a dead-lettered email."""
+    if not database.retry_dead_outbound(message_id):
+        raise HTTPException(status_code=404, detail="Dead-lettered message not found")
+    # Idle outbox workers pick it up on their next poll
+    return {"status": "queued", "id": message_id}
+
 @app.post("/api/extract")
 def extract_data(request: ExtractRequest):
     try:
         # Forced CSS Mode
         print(f"Starting CSS extraction for: {request.url}")
-        data, error = scraper_css.fetch_data(request.url)
-
-        status = "success"
-        if error:
-            status = "failed"
-            import traceback
-            traceback.print_exc() 
-            # Try to log failure to DB, but don't crash if DB fails
-            try:
-                database.add_history(request.url, "Auto-CSS", [], status="failed")
-            except Exception as e:
-                print(f"[DB Error] Failed to log failure: {e}")
-                
-            raise HTTPException(status_code=500, detail=f"Extraction Failed: {error}")
-        
-        # Log success
-        from datetime import datetime
-        import json
-        
-        # Check for duplicate
-        is_duplicate = False
-        try:
-            last_history = database.get_last_history_for_url(request.url)
-            
-            print(f"[DEBUG] last_history found: {last_history is not None}")
-            
-            if last_history:
-                print(f"[DEBUG] last_history timestamp raw: {last_history['timestamp']}")
-                try:
-                    last_time = datetime.strptime(last_history['timestamp'], "%Y-%m-%d %H:%M:%S")
-                except ValueError:
-                    # Try alternate format if default fails
-                    last_time = datetime.fromisoformat(last_history['timestamp'])
-                
-                print(f"[DEBUG] last_time.date(): {last_time.date()}, today: {datetime.now().date()}")
-                
-                if last_time.date() == datetime.now().date():
-                     # Same day check
-                     # Compare data (simplified string compare of JSON dump)
-                     current_json = json.dumps(data, sort_keys=True, ensure_ascii=False)
-                     last_json = json.dumps(json.loads(last_history['data_json']), sort_keys=True, ensure_ascii=False) # Normalize
-                     
-                     print(f"[DEBUG] current_json length: {len(current_json)}")
-                     print(f"[DEBUG] last_json length: {len(last_json)}")
-                     print(f"[DEBUG] JSONs match: {current_json == last_json}")
-                     
-                     if current_json == last_json:
-                         is_duplicate = True
-                         print("Duplicate extraction detected for today.")
-        except Exception as db_e:
-             print(f"[DB Warning] Duplicate check failed: {db_e}")
-
-        try:
-            database.add_history(request.url, "Auto-CSS", data, status="success")
-        except Exception as db_e:
-            print(f"[DB Error] Failed to save history: {db_e}")
-            # We don't stop execution here, purely optional logging? 
-            # No, user wants history. But if DB fails, we should at least return data.
-            pass
-        
-        # Send email notification if email is provided
-        if request.email:
-            import mailer
-            try:
-                if is_duplicate:
-                     subject = f"[360D] 重複確認通知 - 無更新"
-                     mailer.send_repeated_notification_email(request.email, subject)
-                     print(f"Repeated-Check Email sent to {request.email}")
-                else:
-                     subject = f"[360D] 擷取結果 - {len(data)} 筆資料"
-                     mailer.send_notification_email(request.email, subject, updates=data)
-                     print(f"Standard Email sent to {request.email}")
-            except Exception as mail_e:
-                print(f"[Mailer Error] {mail_e}")
-        
-        return {
-            "status": "success",
-            "count": len(data),
-            "data": data
-        }
-
-    except HTTPException:
-        raise
+        return extraction.run_manual_extraction(request.url, request.email)
+
+    except extraction.ExtractionError as e:
+        raise HTTPException(status_code=500, detail=f"Extraction Failed: {e}")
     except Exception as e:
         import traceback
         error_msg = f"Critical Server Error: {str(e)}"
@@ -158,6 +137,49 @@ def extract_data(request: ExtractRequest):
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=error_msg)
 
+@app.post("/api/extract/jobs", status_code=202)
+def create_extract_job(request: ExtractRequest):
+    """Async mode: queues the extraction and returns a job handle immediately."""
+    try:
+        job = extract_jobs.submit(request.url, request.email)
+    except extract_jobs.JobQueueFull as e:
+        raise HTTPException(status_code=429, detail=f"Too many pending extractions: {e}")
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "status_url": f"/api/extract/jobs/{job['id']}",
+        "stream_url": f"/api/extract/jobs/{job['id']}/stream",
+    }
+
+@app.get("/api/extract/jobs/{job_id}")
+def get_extract_job(job_id: str):
+    """Poll an extraction job: queued -> running -> succeeded | failed."""
+    job = extract_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job
+
+@app.get("/api/extract/jobs/{job_id}/stream")
+async def stream_extract_job(job_id: str):
+    """Streams the job state as NDJSON, one line per status change, until it finishes."""
+    if extract_jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+
+    async def events():
+        last_status = None
+        while True:
+            job = extract_jobs.get(job_id)
+            if job is None:
+                return
+            if job["status"] != last_status:
+                last_status = job["status"]
+                yield json.dumps(job, ensure_ascii=False) + "\n"
+            if job["status"] in extract_jobs.TERMINAL_STATES:
+                return
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 @app.post("/api/schedule")
 def schedule_task(request: ScheduleRequest):
     # Pass new fields to database - Defaulting Topic and ScraperType
@@ -166,36 +188,86 @@ def schedule_task(request: ScheduleRequest):
         unit=request.unit, is_continuous=request.is_continuous
     )
     print(f"Scheduling task (CSS) for {request.email}, Freq: {request.frequency} {request.unit}, Continuous: {request.is_continuous}, ID: {schedule_id}")
+    # add_schedule may also deactivate older schedules for this URL+Email, so resync the whole queue
+    import scheduler
+    scheduler.reload_queue()
     return {"status": "success", "message": "Task scheduled successfully", "schedule_id": schedule_id}
 
 @app.get("/api/history")
-def get_history(limit: int = 10):
-    history = database.get_history(limit=limit)
-    # Parse the stringified 'summary' back to JSON if needed, 
-    # but database.get_history returns raw dicts. 
-    # The 'summary' field in db is a string representation of the list.
-    # We might need to clean it up for the frontend.
-    cleaned_history = []
-    for item in history:
-        try:
-            # Safe eval or json load if feasible. 
-            # In app.py it used eval(), which is risky but existing.
-            # We'll stick to basic return for now.
-            count = 0
-            if isinstance(item['summary'], str):
-                 # Quick hack to get count without risky eval if possible, 
-                 # or just return raw string.
-                 pass
-        except:
-            pass
-        cleaned_history.append(item)
-        
-    return cleaned_history
+def get_history(response: Response, limit: int = 10, cursor: Optional[str] = None, url: Optional[str] = None,
+                status: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                fields: Optional[str] = None):
+    """
+    History metadata, newest first. A full page sets X-Next-Cursor; pass it
+    back as `cursor` for the next one. `fields` is a comma-separated subset
+    of the columns (id and timestamp are always returned).
+    """
+    limit = max(1, min(limit, HISTORY_PAGE_MAX))
+    try:
+        history = database.get_history(
+            limit=limit, cursor=cursor, url=url, status=status, since=since, until=until,
+            fields=[field.strip() for field in fields.split(",") if field.strip()] if fields else None,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(history) == limit:
+        response.headers["X-Next-Cursor"] = database.encode_history_cursor(history[-1])
+    return history
+
+@app.get("/api/history/export")
+def export_history_rows(format: str = "ndjson", url: Optional[str] = None,
+                        since: Optional[str] = None, until: Optional[str] = None):
+    """
+    Streams every matching history row with its items, oldest first, as
+    NDJSON or CSV (one line per item). Memory use does not grow with the export.
+    """
+    try:
+        chunks = export_history.export(format, url=url, since=since, until=until)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filename = f"history-{time.strftime('%Y%m%d-%H%M%S')}.{format}"
+    return StreamingResponse(
+        chunks, media_type=export_history.FORMATS[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+@app.get("/api/search")
+def search_items(response: Response, q: str, url: Optional[str] = None, limit: int = 20, offset: int = 0):
+    """
+    Full-text search over every item ever extracted, best match first. A
+    full page sets X-Next-Offset; pass it back as `offset` for the next one.
+    """
+    limit = max(1, min(limit, SEARCH_PAGE_MAX))
+    offset = max(0, offset)
+    results = database.search_items(q, url=url, limit=limit, offset=offset)
+    if len(results) == limit:
+        response.headers["X-Next-Offset"] = str(offset + limit)
+    return results
+
+@app.get("/api/stats/daily")
+def get_daily_stats(url: Optional[str] = None, days: int = 30):
+    """Per-day run counts, failures and changes (rolled up by the retention job)."""
+    return database.get_history_daily(url=url, days=days)
+
+@app.get("/api/history/{history_id}")
+def get_history_entry(history_id: int):
+    """
+    One history row with its extracted items ('data') and what changed since
+    the previous run ('delta': added / modified / removed items, null when
+    nothing changed); the list endpoint returns metadata only.
+    """
+    entry = database.get_history_entry(history_id)
+    if entry is None:
+        raise HTTPException(status_code=404, detail="History entry not found")
+    entry['delta'] = database.get_history_delta(history_id)
+    return entry
 
 @app.patch("/api/schedule/{schedule_id}/pause")
 def toggle_schedule_pause(schedule_id: int, active: bool = False):
     """Toggle a schedule's active status."""
     database.toggle_schedule_active(schedule_id, active)
+    import scheduler
+    scheduler.schedule_updated(schedule_id)
     status = "resumed" if active else "paused"
     return {"status": "success", "message": f"Schedule {status}"}
 
@@ -209,6 +281,8 @@ def get_schedules():
 def stop_all_schedules():
     """Stop all active schedules."""
     count = database.deactivate_all_schedules()
+    import scheduler
+    scheduler.reload_queue()
     print(f"[API] Stopped {count} schedules")
     return {"status": "success", "message": f"Stopped {count} schedules", "count": count}
 
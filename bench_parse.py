@@ -0,0 +1,49 @@
+"""
+Parse-cost benchmark over the recorded site_dump.html fixture.
+
+Compares full-document and scoped parsing for each available backend and
+checks that every variant finds the same containers.
+
+Usage: python bench_parse.py [path/to/page.html] [--runs N]
+"""
+import argparse
+import statistics
+import time
+
+import html_backend
+import selector_schema
+
+
+def bench(html: str, backend: str, containers, targets, runs: int):
+    timings = []
+    found = 0
+    for _ in range(runs):
+        start = time.perf_counter()
+        soup = html_backend.parse(html, containers=containers, backend=backend)
+        found = sum(len(soup.select(f".{name}")) for name in targets)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings), found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("page", nargs="?", default="site_dump.html")
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    with open(args.page, encoding="utf-8") as f:
+        html = f.read()
+    print(f"Page: {args.page} ({len(html.encode('utf-8')) / 1024:.1f} KB), {args.runs} runs each")
+
+    targets = selector_schema.get_compiled(selector_schema.schema_for_url("https://www.roccrane.org.tw/")).container_classes
+    backends = ["html.parser"] + (["lxml"] if html_backend.HAS_LXML else [])
+    baseline = None
+    for backend in backends:
+        for label, containers in (("full", None), ("scoped", targets)):
+            median_ms, found = bench(html, backend, containers, targets, args.runs)
+            baseline = baseline or median_ms
+            print(f"  {backend:<12} {label:<7} {median_ms:8.2f} ms  ({baseline / median_ms:4.1f}x)  containers={found}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+"""
+Offline benchmark for the extraction pipeline.
+
+Replays recorded pages (default: site_dump.html) through a local HTTP
+stand-in and runs the real code path, extraction.check_url (fetch cache,
+conditional GET, coalescing, scraper, dedupe, history) plus the email
+render, reading each stage's time from the metrics the code already records:
+
+    network   HTTP GET and streamed body read   scraper_stage_seconds
+    decode    charset resolution + decode        scraper_stage_seconds
+    parse     scoped HTML parse                   scraper_stage_seconds
+    extract   selector schema extraction          scraper_stage_seconds
+    fetch     whole scraper call, including the above plus schema and
+              fetch-cache lookups                 scraper_fetch_seconds
+    dedupe    last digest lookup                  db_query_seconds
+    db_write  history row + item delta            db_query_seconds
+    check_url extraction.check_url end to end (includes fetch..db_write)
+    render    notification email body (mailer)
+
+Cold runs reset every cache first (connection pool, charset cache, compiled
+schemas and XPath, a fresh database); warm runs reuse them, as a long-running
+server would. With --revalidate the stand-in sends an ETag and answers 304,
+so warm runs measure the conditional-GET path. Results (p50/p90/p99 per
+stage, in ms) are written as JSON and can be compared with an earlier file.
+
+Usage:
+    python bench_pipeline.py [page.html ...] [--runs N] [--cold-runs N] [--revalidate]
+                             [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Never touch the real database
+_TMP_DIR = tempfile.mkdtemp(prefix="bench_pipeline_")
+os.environ["ZEABUR_VAR_DB_PATH"] = os.path.join(_TMP_DIR, "bench.db")
+
+import charset_resolver
+import database
+import extraction
+import html_backend
+import http_client
+import mailer
+import scraper_css
+import selector_schema
+
+# Every run must do its own fetch rather than reuse the previous run's result
+extraction.COALESCE_WINDOW_SECONDS = 0
+
+STAGES = ["network", "decode", "parse", "extract", "fetch", "dedupe", "db_write", "check_url", "render"]
+
+# Stage -> (histogram, label values counted in it)
+_RECORDED = {
+    "network": (scraper_css.STAGE_SECONDS, lambda key: key == ("network",)),
+    "decode": (scraper_css.STAGE_SECONDS, lambda key: key == ("decode",)),
+    "parse": (scraper_css.STAGE_SECONDS, lambda key: key == ("parse",)),
+    "extract": (scraper_css.STAGE_SECONDS, lambda key: key == ("extract",)),
+    "fetch": (scraper_css.FETCH_SECONDS, lambda key: True),
+    "dedupe": (database.QUERY_SECONDS, lambda key: key[0] == "get_last_history_digest"),
+    "db_write": (database.QUERY_SECONDS, lambda key: key[0] in ("add_history", "apply_item_delta")),
+}
+
+
+class _ReplayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    pages = {}
+    revalidate = False
+
+    def do_GET(self):
+        body = self.pages.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.revalidate and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        if self.revalidate:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Streaming fetches may hang up once the target containers are read
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+def start_server(paths):
+    """Serves each recorded page at /<basename> on a free local port."""
+    pages = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            pages["/" + os.path.basename(path)] = f.read()
+    _ReplayHandler.pages = pages
+    server = _QuietServer(("127.0.0.1", 0), _ReplayHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def reset_caches(db_path: str):
+    http_client.reset_session()
+    charset_resolver.clear_cache()
+    selector_schema.clear_cache()
+    html_backend.clear_cache()
+    use_database(db_path)
+
+
+def use_database(db_path: str):
+    database.close_connection()
+    database.DB_PATH = db_path
+    database.init_db()
+
+
+def _recorded_totals():
+    return {histogram.name: histogram.totals() for histogram, _ in _RECORDED.values()}
+
+
+def _recorded_ms(stage: str, before, after) -> float:
+    histogram, counted = _RECORDED[stage]
+    old, new = before[histogram.name], after[histogram.name]
+    return sum(total - old.get(key, (0, 0.0))[1] for key, (_, total) in new.items() if counted(key)) * 1000
+
+
+def run_once(url: str):
+    """Runs the pipeline once through extraction.check_url; returns ({stage: ms}, item count)."""
+    before = _recorded_totals()
+    start = time.perf_counter()
+    result = extraction.check_url(url, status="success")
+    checked = time.perf_counter()
+    if result["error"]:
+        raise RuntimeError(f"{url}: {result['error']}")
+    mailer.build_notification_body(result["data"])
+    end = time.perf_counter()
+    after = _recorded_totals()
+
+    timings = {stage: _recorded_ms(stage, before, after) for stage in _RECORDED}
+    timings["check_url"] = (checked - start) * 1000
+    timings["render"] = (end - checked) * 1000
+    timings["total"] = (end - start) * 1000
+    return timings, len(result["data"])
+
+
+def percentile(values, pct: float) -> float:
+    """Linear-interpolated percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(samples):
+    summary = {}
+    for stage in STAGES + ["total"]:
+        values = [s[stage] for s in samples]
+        summary[stage] = {
+            "p50": round(percentile(values, 50), 3),
+            "p90": round(percentile(values, 90), 3),
+            "p99": round(percentile(values, 99), 3),
+            "mean": round(sum(values) / len(values), 3),
+            "min": round(min(values), 3),
+            "max": round(max(values), 3),
+        }
+    return summary
+
+
+def bench_page(url: str, cold_runs: int, runs: int, warmup: int):
+    cold, warm = [], []
+    items = 0
+    # Library logging would drown the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(cold_runs):
+            reset_caches(os.path.join(_TMP_DIR, f"cold-{i}.db"))
+            timings, items = run_once(url)
+            cold.append(timings)
+
+        use_database(os.path.join(_TMP_DIR, "warm.db"))
+        for _ in range(warmup):
+            run_once(url)
+        for _ in range(runs):
+            timings, items = run_once(url)
+            warm.append(timings)
+    return {"items": items, "cold": summarize(cold), "warm": summarize(warm)}
+
+
+def print_report(results):
+    for page, page_result in results["pages"].items():
+        print(f"\n{page} ({page_result['bytes'] / 1024:.1f} KB, {page_result['items']} items)")
+        print(f"  {'stage':<10} {'cold p50':>10} {'cold p99':>10} {'warm p50':>10} {'warm p90':>10} {'warm p99':>10}")
+        for stage in STAGES + ["total"]:
+            cold = page_result["cold"][stage]
+            warm = page_result["warm"][stage]
+            print(f"  {stage:<10} {cold['p50']:10.2f} {cold['p99']:10.2f} "
+                  f"{warm['p50']:10.2f} {warm['p90']:10.2f} {warm['p99']:10.2f}")
+
+
+def compare(results, baseline_path: str, threshold: float, min_delta_ms: float) -> bool:
+    """
+    Prints p50 changes against a baseline file; returns True if any stage got
+    slower by more than `threshold` percent and `min_delta_ms` (sub-millisecond
+    stages are too noisy for a percentage alone).
+    """
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressed = False
+    print(f"\nCompared with {baseline_path} ({baseline.get('created_at', '?')}), threshold {threshold:.0f}%")
+    for page, page_result in results["pages"].items():
+        base_page = baseline.get("pages", {}).get(page)
+        if not base_page:
+            print(f"  {page}: not in baseline")
+            continue
+        for mode in ("cold", "warm"):
+            for stage in STAGES + ["total"]:
+                before = base_page.get(mode, {}).get(stage, {}).get("p50")
+                after = page_result[mode][stage]["p50"]
+                if not before:
+                    continue
+                change = (after - before) / before * 100
+                flag = ""
+                if change > threshold and after - before > min_delta_ms:
+                    flag = "  REGRESSION"
+                    regressed = True
+                print(f"  {page} {mode:<4} {stage:<10} {before:9.2f} -> {after:9.2f} ms  ({change:+6.1f}%){flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pages", nargs="*", default=["site_dump.html"])
+    parser.add_argument("--runs", type=int, default=50, help="warm runs per page")
+    parser.add_argument("--cold-runs", type=int, default=10, help="cold runs per page")
+    parser.add_argument("--warmup", type=int, default=3, help="untimed warm runs before measuring")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=20.0, help="p50 regression threshold in percent")
+    parser.add_argument("--min-delta-ms", type=float, default=0.5, help="ignore regressions smaller than this")
+    parser.add_argument("--revalidate", action="store_true", help="serve ETags and 304s (conditional-GET path)")
+    args = parser.parse_args()
+    _ReplayHandler.revalidate = args.revalidate
+
+    server = start_server(args.pages)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    print(f"Replaying {len(args.pages)} page(s) from {base_url}: "
+          f"{args.cold_runs} cold / {args.runs} warm runs each, parser={html_backend.available_backend()}, "
+          f"streaming={scraper_css.STREAMING}, revalidate={args.revalidate}")
+
+    results = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "parser_backend": html_backend.available_backend(),
+        "streaming": scraper_css.STREAMING,
+        "revalidate": args.revalidate,
+        "cold_runs": args.cold_runs,
+        "runs": args.runs,
+        "pages": {},
+    }
+    try:
+        for path in args.pages:
+            name = os.path.basename(path)
+            page_result = bench_page(f"{base_url}/{name}", args.cold_runs, args.runs, args.warmup)
+            page_result["bytes"] = len(_ReplayHandler.pages["/" + name])
+            results["pages"][name] = page_result
+    finally:
+        server.shutdown()
+        database.close_connection()
+        shutil.rmtree(_TMP_DIR, ignore_errors=True)
+
+    print_report(results)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare and compare(results, args.compare, args.threshold, args.min_delta_ms):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
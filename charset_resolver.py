@@ -0,0 +1,113 @@
+"""
+Response charset resolution without running a detector on every fetch.
+
+Order: HTTP Content-Type charset and <meta charset> (when they agree or only
+one is present), then the encoding last detected for the same host, then
+statistical detection (the same detector behind requests' apparent_encoding).
+A declared or cached encoding that fails to decode the body is not trusted,
+which keeps mislabelled pages from turning into mojibake.
+"""
+import codecs
+import re
+import threading
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+
+# How much of the body to scan for <meta charset>
+META_SCAN_BYTES = 4096
+
+# Superset codecs browsers actually use for these labels
+_ALIASES = {
+    "big5": "cp950",
+    "gb2312": "gbk",
+}
+
+_META_CHARSET = re.compile(
+    rb"""<meta[^>]+charset\s*=\s*["']?\s*([A-Za-z0-9_.:-]+)""",
+    re.IGNORECASE,
+)
+_HEADER_CHARSET = re.compile(r"""charset\s*=\s*["']?([A-Za-z0-9_.:-]+)""", re.IGNORECASE)
+
+_host_cache: Dict[str, str] = {}
+_host_cache_lock = threading.Lock()
+
+
+def clear_cache():
+    """Forgets the per-host detected encodings."""
+    with _host_cache_lock:
+        _host_cache.clear()
+
+
+def normalize(label: Optional[str]) -> Optional[str]:
+    """Canonical Python codec name for a charset label, or None if unknown."""
+    if not label:
+        return None
+    try:
+        name = codecs.lookup(label.strip()).name
+    except LookupError:
+        return None
+    return _ALIASES.get(name, name)
+
+
+def header_charset(content_type: Optional[str]) -> Optional[str]:
+    if not content_type:
+        return None
+    match = _HEADER_CHARSET.search(content_type)
+    return normalize(match.group(1)) if match else None
+
+
+def meta_charset(body: bytes) -> Optional[str]:
+    match = _META_CHARSET.search(body[:META_SCAN_BYTES])
+    return normalize(match.group(1).decode("ascii", "ignore")) if match else None
+
+
+def detect(body: bytes) -> str:
+    return normalize(requests.compat.chardet.detect(body)["encoding"]) or "utf-8"
+
+
+def _host(url: str) -> str:
+    return (urlparse(url).hostname or "").lower()
+
+
+def _try_decode(body: bytes, encoding: str) -> Optional[str]:
+    """Strict decode; a multi-byte sequence cut off at the very end (streamed body) is tolerated."""
+    try:
+        return body.decode(encoding)
+    except UnicodeDecodeError as e:
+        if e.start >= len(body) - 4:
+            return body.decode(encoding, errors="replace")
+        return None
+    except LookupError:
+        return None
+
+
+def decode(url: str, headers, body: bytes) -> Tuple[str, str]:
+    """Returns (text, encoding) for a response body."""
+    declared_header = header_charset(headers.get("Content-Type"))
+    declared_meta = meta_charset(body)
+
+    candidate = None
+    if declared_header and declared_meta:
+        if declared_header == declared_meta:
+            candidate = declared_header
+    else:
+        candidate = declared_header or declared_meta
+
+    host = _host(url)
+    if candidate is None:
+        with _host_cache_lock:
+            candidate = _host_cache.get(host)
+
+    if candidate:
+        text = _try_decode(body, candidate)
+        if text is not None:
+            return text, candidate
+        print(f"[Charset] {host}: body is not valid {candidate}, detecting")
+
+    encoding = detect(body)
+    with _host_cache_lock:
+        _host_cache[host] = encoding
+    print(f"[Charset] {host}: detected {encoding}")
+    return body.decode(encoding, errors="replace"), encoding
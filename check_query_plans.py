@@ -0,0 +1,211 @@
+"""
+Runs EXPLAIN QUERY PLAN on every query issued by database.py and fails if
+any of them reads a whole table, including a full walk of an index, unless
+the scan is listed in EXEMPT_SCANS with the reason it is intended.
+
+Each public database function is called against a throw-away database while
+a trace callback records the statements it executes. Functions without an
+entry in EXERCISES are reported too, so new queries cannot slip past the audit.
+
+Usage: python check_query_plans.py
+"""
+import inspect
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+import database
+
+URL = "https://www.roccrane.org.tw/"
+
+
+def exercise_history_pages():
+    """First page, a later page and each filter of the keyset-paginated history list."""
+    cursor = database.encode_history_cursor({"timestamp": "2024-01-01 00:00:00", "id": 1})
+    database.get_history(limit=10)
+    database.get_history(limit=10, cursor=cursor)
+    database.get_history(limit=10, cursor=cursor, url=URL, since="2023-12-01", until="2024-01-01",
+                         fields=["url", "status"])
+    database.get_history(limit=10, cursor=cursor, status="failed")
+
+
+# How to call each database function with representative arguments
+EXERCISES = {
+    "add_history": lambda: database.add_history(URL, "Auto-CSS", [{"title": "t", "link": URL, "date": "2024-01-01"}]),
+    "get_history": lambda: exercise_history_pages(),
+    "iter_history_export": lambda: (list(database.iter_history_export()),
+                                    list(database.iter_history_export(url=URL, since="2024-01-01", until="2024-02-01"))),
+    "search_items": lambda: (database.search_items("roccrane news", limit=10, offset=10),
+                             database.search_items("公告", url=URL, limit=10),
+                             database.search_items("活動 公告欄", limit=10)),
+    "get_history_entry": lambda: database.get_history_entry(1),
+    "get_last_history_for_url": lambda: database.get_last_history_for_url(URL),
+    "get_last_history_digest": lambda: database.get_last_history_digest(URL),
+    "compute_content_hash": lambda: database.compute_content_hash([]),
+    "apply_item_delta": lambda: database.apply_item_delta(URL, 1, [{"title": "t2", "link": URL, "date": "2024-01-02"}]),
+    "get_history_delta": lambda: database.get_history_delta(1),
+    "get_fetch_cache": lambda: database.get_fetch_cache(URL),
+    "save_fetch_cache": lambda: database.save_fetch_cache(URL, '"etag"', None, []),
+    "add_schedule": lambda: database.add_schedule(URL, "Auto-CSS", "user@example.com", 1, "CSS"),
+    "get_due_schedules": lambda: database.get_due_schedules(),
+    "update_schedule_next_run": lambda: database.update_schedule_next_run(1, 1),
+    "get_schedule": lambda: database.get_schedule(1),
+    "toggle_schedule_active": lambda: database.toggle_schedule_active(1, True),
+    "get_active_schedules": lambda: database.get_active_schedules(),
+    "deactivate_all_schedules": lambda: database.deactivate_all_schedules(),
+    "enqueue_outbound": lambda: database.enqueue_outbound("schedule:1:history:1", "user@example.com", "s", "<p>b</p>"),
+    "claim_outbound": lambda: database.claim_outbound(10),
+    "mark_outbound_sent": lambda: database.mark_outbound_sent(1),
+    "mark_outbound_failed": lambda: database.mark_outbound_failed(1, "error", retry_in_seconds=30),
+    "requeue_stale_outbound": lambda: database.requeue_stale_outbound(),
+    "get_outbound_stats": lambda: database.get_outbound_stats(),
+    "get_dead_outbound": lambda: database.get_dead_outbound(limit=10),
+    "retry_dead_outbound": lambda: database.retry_dead_outbound(1),
+    "add_digest_item": lambda: database.add_digest_item("schedule:1:history:1", "user@example.com", URL, "s", []),
+    "get_due_digest_recipients": lambda: database.get_due_digest_recipients(60),
+    "get_pending_digest_items": lambda: database.get_pending_digest_items("user@example.com"),
+    "rollup_history_daily": lambda: database.rollup_history_daily(),
+    "get_history_daily": lambda: database.get_history_daily(url=URL, days=30),
+    "find_prunable_history": lambda: database.find_prunable_history(20, 7, after=("2024-01-01 00:00:00", 1), limit=100),
+    "delete_history_rows": lambda: database.delete_history_rows([1]),
+    "purge_delivered_notifications": lambda: database.purge_delivered_notifications(30),
+    "incremental_vacuum": lambda: database.incremental_vacuum(10),
+    "enable_incremental_vacuum": lambda: database.enable_incremental_vacuum(),
+    "flush_digest": lambda: database.flush_digest([1], "digest:user@example.com:1-1", "user@example.com", "s", "<p>b</p>"),
+}
+
+# Not query functions: connection management, schema creation and cursor encoding
+SKIP = {"open_connection", "get_connection", "close_connection", "transaction", "init_db",
+        "encode_history_cursor", "decode_history_cursor"}
+
+# INSERT ... VALUES has no plan steps; INSERT ... SELECT is audited like its SELECT
+CHECKED_PREFIXES = ("SELECT", "UPDATE", "DELETE", "WITH", "INSERT", "REPLACE")
+
+# Whole-table reads that are intended, by (function, scanned table or alias)
+EXEMPT_SCANS = {
+    ("get_active_schedules", "schedules"):
+        "lists every active schedule; walks the partial index, which holds active rows only",
+    ("deactivate_all_schedules", "schedules"):
+        "stops every active schedule; walks the partial index, which holds active rows only",
+    ("get_outbound_stats", "outbound_queue"):
+        "counts the queue by status for /api/outbox and metrics; sent rows are purged by retention",
+    ("iter_history_export", "h"):
+        "an unfiltered export reads every row by definition, streamed in batches",
+}
+
+
+def database_functions():
+    return sorted(
+        name for name, fn in inspect.getmembers(database, inspect.isfunction)
+        if fn.__module__ == database.__name__ and not name.startswith("_") and name not in SKIP
+    )
+
+
+def cte_names(sql: str) -> set:
+    pattern = r"(?:\bWITH|,)\s*(\w+)\s+AS\s*(?:NOT\s+)?(?:MATERIALIZED\s*)?\("
+    return {name.lower() for name in re.findall(pattern, sql, re.IGNORECASE)}
+
+
+def is_full_scan(detail: str, sql: str, plan: list, transient: set = frozenset()) -> bool:
+    """
+    SCAN steps that read a subquery / CTE result built from indexed access,
+    the schema table (its size does not grow with the data) or a constant
+    row are fine. A virtual table scan is fine when the module was given a
+    constraint (e.g. FTS5 "INDEX 0:M3"; "INDEX 0:" is a full scan). An index
+    or rowid walk (constrained ones show up as SEARCH) is only fine when it
+    stops after LIMIT rows: the index serves the ORDER BY (no temp B-tree) and
+    nothing can reject the rows it walks, i.e. no WHERE clause and no
+    subquery step. Everything else reads the whole table.
+    """
+    if not detail.startswith("SCAN "):
+        return False
+    target = detail.split()[1]
+    if target.startswith("(subquery-") or target.lower() in transient:
+        return False
+    if target in ("sqlite_master", "sqlite_schema") or "CONSTANT ROW" in detail:
+        return False
+    if "VIRTUAL TABLE" in detail:
+        return not re.search(r"INDEX \d+:\S", detail)
+    if any(marker in detail for marker in ("USING INDEX", "USING COVERING INDEX", "USING INTEGER PRIMARY KEY")):
+        early_exit = (
+            re.search(r"\bLIMIT\b", sql, re.IGNORECASE)
+            and re.search(r"\bORDER BY\b", sql, re.IGNORECASE)
+            and not re.search(r"\bWHERE\b", sql, re.IGNORECASE)
+            and not any("USE TEMP B-TREE" in step or "SUBQUERY" in step for step in plan)
+        )
+        return not early_exit
+    return True
+
+
+def main() -> int:
+    statements = []
+    original_get_connection = database.get_connection
+    original_open_connection = database.open_connection
+
+    def traced_connection(*args, **kwargs):
+        conn = original_get_connection(*args, **kwargs)
+        conn.set_trace_callback(lambda sql: statements.append((current[0], sql)))
+        return conn
+
+    # Streaming readers open a dedicated connection instead of the thread's one
+    def traced_open_connection(*args, **kwargs):
+        conn = original_open_connection(*args, **kwargs)
+        conn.set_trace_callback(lambda sql: statements.append((current[0], sql)))
+        return conn
+
+    current = [None]
+    problems = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, "plan_audit.db")
+        database.init_db()
+        database.get_connection = traced_connection
+        database.open_connection = traced_open_connection
+        try:
+            for name in database_functions():
+                exercise = EXERCISES.get(name)
+                if exercise is None:
+                    problems.append(f"{name}: no exercise registered in check_query_plans.EXERCISES")
+                    continue
+                current[0] = name
+                exercise()
+        finally:
+            database.get_connection = original_get_connection
+            database.open_connection = original_open_connection
+            database.close_connection()
+
+        conn = sqlite3.connect(database.DB_PATH)
+        seen = set()
+        for name, sql in statements:
+            normalized = " ".join(sql.split())
+            if not normalized.upper().startswith(CHECKED_PREFIXES) or normalized in seen:
+                continue
+            seen.add(normalized)
+            plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")]
+            transient = cte_names(normalized)
+            scans = [detail for detail in plan if is_full_scan(detail, normalized, plan, transient)]
+            exempt = [detail for detail in scans if (name, detail.split()[1]) in EXEMPT_SCANS]
+            scans = [detail for detail in scans if detail not in exempt]
+            status = "FULL SCAN" if scans else ("exempt" if exempt else "ok")
+            print(f"[{status}] {name}: {normalized}")
+            for detail in plan:
+                print(f"    {detail}")
+            for detail in exempt:
+                print(f"    exempt: {EXEMPT_SCANS[(name, detail.split()[1])]}")
+            if scans:
+                problems.append(f"{name}: {', '.join(scans)}")
+        conn.close()
+
+    if problems:
+        print("\nQuery plan audit failed:")
+        for problem in problems:
+            print(f"  - {problem}")
+        return 1
+    print("\nQuery plan audit passed.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
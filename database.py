@@ -1,143 +1,773 @@
 import sqlite3
 import os
 import json
+import re
+import base64
+import binascii
+import hashlib
+import threading
+import zlib
+from contextlib import contextmanager
 from datetime import datetime
 from typing import List, Optional, Dict, Any
 
+import metrics
+
 # Zeabur Volume Path or Local fallback
 DB_FOLDER = os.getenv("ZEABUR_VAR_DB_PATH", ".")
 DB_PATH = os.path.join(DB_FOLDER, "360d.db")
 
-def get_connection():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Time spent in each query function below, by outcome
+QUERY_SECONDS = metrics.Histogram("db_query_seconds", "Time spent in database query functions", ["function", "outcome"])
 
-def init_db():
-    conn = get_connection()
-    c = conn.cursor()
-    
-    # History Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+# Versioned migrations, applied in order and tracked in PRAGMA user_version.
+# Append new (version, [statements]) entries; never edit an applied one.
+# A statement may also be a callable taking the cursor (data migrations).
+SCHEMA_MIGRATIONS = [
+    (1, [
+        "CREATE INDEX IF NOT EXISTS idx_history_url_timestamp ON history(url, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history(timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_schedules_active_next_run ON schedules(next_run) WHERE is_active = 1",
+        "CREATE INDEX IF NOT EXISTS idx_schedules_active_url_email ON schedules(url, email) WHERE is_active = 1",
+    ]),
+    (2, [
+        # Canonical digest of data_json; legacy rows stay NULL and are hashed on read
+        "ALTER TABLE history ADD COLUMN content_hash TEXT",
+    ]),
+    (3, [
+        # Per-URL index of the items seen on the last run, keyed on item_diff.item_key
+        '''CREATE TABLE IF NOT EXISTS item_index (
             url TEXT NOT NULL,
-            topic TEXT NOT NULL,
-            summary TEXT,
-            data_json TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            status TEXT
-        )
-    ''')
-    
-    # Schedules Table
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS schedules (
+            item_key TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            item_json TEXT NOT NULL,
+            first_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (url, item_key)
+        ) WITHOUT ROWID''',
+        # Added / modified / removed items per history row (only rows that changed something)
+        '''CREATE TABLE IF NOT EXISTS history_delta (
+            history_id INTEGER PRIMARY KEY,
+            added INTEGER NOT NULL,
+            modified INTEGER NOT NULL,
+            removed INTEGER NOT NULL,
+            delta_json TEXT NOT NULL
+        )''',
+    ]),
+    (4, [
+        # Hash of the selector schema that produced the cached result
+        "ALTER TABLE fetch_cache ADD COLUMN schema_hash TEXT",
+    ]),
+    (5, [
+        # Durable outbound notifications, drained by outbox.py workers.
+        # status: pending -> sending -> sent, or dead after the last failed attempt
+        '''CREATE TABLE IF NOT EXISTS outbound_queue (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            to_email TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_outbound_status_next_attempt ON outbound_queue(status, next_attempt_at)",
+    ]),
+    (6, [
+        # Scheduled results waiting to be merged into one digest email per recipient;
+        # outbound_id is set once the part has gone out in a digest
+        '''CREATE TABLE IF NOT EXISTS digest_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            to_email TEXT NOT NULL,
             url TEXT NOT NULL,
-            topic TEXT NOT NULL,
-            email TEXT NOT NULL,
-            frequency_days INTEGER NOT NULL,
-            last_run DATETIME,
-            next_run DATETIME,
-            is_active BOOLEAN DEFAULT 1,
+            subject TEXT NOT NULL,
+            updates_json TEXT NOT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            outbound_id INTEGER
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_digest_items_pending ON digest_items(to_email, created_at) WHERE outbound_id IS NULL",
+    ]),
+    (7, [
+        # Content-addressed extraction payloads (key = history.content_hash), compressed.
+        # history keeps only metadata plus payload_hash; data_json stays NULL for new rows
+        '''CREATE TABLE IF NOT EXISTS payloads (
+            hash TEXT PRIMARY KEY,
+            encoding TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL,
             created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Migrations - Use helper to avoid repetition and indentation errors
-    migrations = [
-        "ALTER TABLE schedules ADD COLUMN url TEXT DEFAULT ''",
-        "ALTER TABLE schedules ADD COLUMN topic TEXT DEFAULT ''",
-        "ALTER TABLE schedules ADD COLUMN scraper_type TEXT DEFAULT 'AI'",
-        "ALTER TABLE schedules ADD COLUMN unit TEXT DEFAULT 'days'",
-        "ALTER TABLE schedules ADD COLUMN is_continuous BOOLEAN DEFAULT 1"
-    ]
-    
-    for query in migrations:
-        try:
-            c.execute(query)
-        except sqlite3.OperationalError:
-            pass # Column likely exists
-    
-    conn.commit()
-    conn.close()
+        )''',
+        "ALTER TABLE history ADD COLUMN payload_hash TEXT",
+        lambda c: _move_history_payloads(c),
+    ]),
+    (8, [
+        # Orphaned-payload cleanup (delete_history_rows) looks payloads up by reference
+        "CREATE INDEX IF NOT EXISTS idx_history_payload_hash ON history(payload_hash)",
+        # Per-day, per-URL run statistics; survive the pruning of the rows they summarize
+        '''CREATE TABLE IF NOT EXISTS history_daily (
+            day TEXT NOT NULL,
+            url TEXT NOT NULL,
+            runs INTEGER NOT NULL,
+            failures INTEGER NOT NULL,
+            changes INTEGER NOT NULL,
+            items INTEGER NOT NULL,
+            PRIMARY KEY (day, url)
+        ) WITHOUT ROWID''',
+        "CREATE INDEX IF NOT EXISTS idx_digest_items_outbound ON digest_items(outbound_id)",
+    ]),
+    (9, [
+        # Keyset pages of /api/history filtered by status (the url filter uses idx_history_url_timestamp)
+        "CREATE INDEX IF NOT EXISTS idx_history_status_timestamp ON history(status, timestamp)",
+    ]),
+    (10, [
+        # Searchable text of every item in every payload; items_fts indexes it (see _create_items_fts)
+        '''CREATE TABLE IF NOT EXISTS payload_items (
+            id INTEGER PRIMARY KEY,
+            payload_hash TEXT NOT NULL,
+            title TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            link TEXT NOT NULL
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_payload_items_payload_hash ON payload_items(payload_hash)",
+        lambda c: _create_items_fts(c),
+        lambda c: _backfill_payload_items(c),
+    ]),
+    (11, [
+        # Unigrams and bigrams of the same text, for search terms too short for
+        # the trigram index (two-character Chinese words); see _item_grams
+        "CREATE VIRTUAL TABLE IF NOT EXISTS items_grams USING fts5("
+        "title, summary, link, content='', tokenize='unicode61')",
+        lambda c: _backfill_items_grams(c),
+    ]),
+]
 
-def add_history(url: str, topic: str, data: List[Dict], status: str = "success"):
+# zlib level for history payloads (zstd is not in the standard library;
+# payloads.encoding leaves room for other codecs)
+PAYLOAD_COMPRESSION_LEVEL = int(os.getenv("DB_PAYLOAD_COMPRESSION_LEVEL", "6"))
+
+# Connection tuning, applied to every connection when it is opened
+BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "8192"))
+
+# Rows fetched per round trip by iter_history_export
+EXPORT_BATCH_SIZE = int(os.getenv("DB_EXPORT_BATCH_SIZE", "500"))
+
+_local = threading.local()
+
+def open_connection(check_same_thread: bool = True):
+    """Opens a new, tuned connection that the caller owns and must close."""
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=check_same_thread)
+    conn.row_factory = sqlite3.Row
+    # Lets retention.py hand free pages back in small slices. Only takes effect
+    # on a new, empty file (and before WAL is enabled); retention.py converts old ones
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    # WAL lets the scheduler write while API threads read
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    # Negative cache_size is in KiB
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    return conn
+
+def get_connection():
+    """
+    Returns this thread's persistent connection, opening it on first use.
+    Do not close it; use close_connection() when a thread is done with the DB.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.path != DB_PATH:
+        if conn is not None:
+            conn.close()
+        conn = open_connection()
+        _local.conn = conn
+        _local.path = DB_PATH
+    return conn
+
+def close_connection():
+    """Closes this thread's persistent connection, if any."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+@contextmanager
+def transaction():
+    """Yields a cursor on this thread's connection; commits on success, rolls back on error."""
     conn = get_connection()
-    c = conn.cursor()
+    try:
+        yield conn.cursor()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def init_db():
+    with transaction() as c:
+        # History Table
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                summary TEXT,
+                data_json TEXT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                status TEXT
+            )
+        ''')
+        
+        # Schedules Table
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS schedules (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                email TEXT NOT NULL,
+                frequency_days INTEGER NOT NULL,
+                last_run DATETIME,
+                next_run DATETIME,
+                is_active BOOLEAN DEFAULT 1,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Conditional GET cache: validators + last extracted result per URL
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS fetch_cache (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                data_json TEXT,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Migrations - Use helper to avoid repetition and indentation errors
+        migrations = [
+            "ALTER TABLE schedules ADD COLUMN url TEXT DEFAULT ''",
+            "ALTER TABLE schedules ADD COLUMN topic TEXT DEFAULT ''",
+            "ALTER TABLE schedules ADD COLUMN scraper_type TEXT DEFAULT 'AI'",
+            "ALTER TABLE schedules ADD COLUMN unit TEXT DEFAULT 'days'",
+            "ALTER TABLE schedules ADD COLUMN is_continuous BOOLEAN DEFAULT 1"
+        ]
+        
+        for query in migrations:
+            try:
+                c.execute(query)
+            except sqlite3.OperationalError:
+                pass # Column likely exists
+
+    _apply_migrations(get_connection())
+
+def _apply_migrations(conn):
+    """
+    Applies pending SCHEMA_MIGRATIONS, each in its own explicit transaction
+    together with its user_version bump. sqlite3 does not open a transaction
+    for DDL on its own, so without the BEGIN an ALTER TABLE would commit by
+    itself and an interrupted migration could never be re-run.
+    """
+    for target, statements in SCHEMA_MIGRATIONS:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= target:
+            continue
+        c = conn.cursor()
+        # IMMEDIATE takes the write lock up front; re-reading the version under
+        # it keeps two processes from applying the same migration
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if c.execute("PRAGMA user_version").fetchone()[0] >= target:
+                conn.rollback()
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(c)
+                else:
+                    c.execute(statement)
+            c.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+        except BaseException:
+            # Including KeyboardInterrupt: never leave a half-applied migration open
+            conn.rollback()
+            raise
+        print(f"[DB] Applied schema migration {target}")
+
+def compute_content_hash(data: List[Dict]) -> str:
+    """Canonical SHA-256 of extracted data: key order and whitespace do not affect it."""
+    canonical = json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def _store_payload(c, content_hash: str, data_json: str) -> bool:
+    """
+    Stores a payload once per content hash; identical runs only reference it.
+    Returns True if the payload is new.
+    """
+    c.execute("SELECT 1 FROM payloads WHERE hash = ?", (content_hash,))
+    if c.fetchone():
+        return False
+    raw = data_json.encode("utf-8")
+    c.execute(
+        "INSERT OR IGNORE INTO payloads (hash, encoding, size, data) VALUES (?, 'zlib', ?, ?)",
+        (content_hash, len(raw), zlib.compress(raw, PAYLOAD_COMPRESSION_LEVEL))
+    )
+    return c.rowcount > 0
+
+def _create_items_fts(c):
+    """
+    Migration 10: FTS5 index over payload_items. The trigram tokenizer
+    (SQLite 3.34+) matches any substring of 3+ characters, which is what
+    Chinese text without word breaks needs; older SQLite gets unicode61.
+    """
+    for tokenizer in ("trigram", "unicode61"):
+        try:
+            c.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5("
+                "title, summary, link, content='payload_items', content_rowid='id', "
+                f"tokenize='{tokenizer}')"
+            )
+            print(f"[DB] Item search index uses the {tokenizer} tokenizer")
+            return
+        except sqlite3.OperationalError as e:
+            if "tokenizer" not in str(e):
+                raise
+
+_ITEM_GRAM_RUN = re.compile(r"[^\W_]+")
+
+def _item_grams(text: str) -> str:
+    """
+    Every 1- and 2-character substring of the letter/digit runs of `text`,
+    space separated, for items_grams. Must stay stable: removing an item
+    from the contentless index repeats the exact text it was indexed with.
+    """
+    grams = []
+    for run in _ITEM_GRAM_RUN.findall(text.lower()):
+        grams.extend(run)
+        grams.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return " ".join(grams)
+
+def _item_grams_rows(c, payload_hash: str):
+    c.execute("SELECT id, title, summary, link FROM payload_items WHERE payload_hash = ?", (payload_hash,))
+    return [
+        (row['id'], _item_grams(row['title']), _item_grams(row['summary']), _item_grams(row['link']))
+        for row in c.fetchall()
+    ]
+
+def _index_payload_items(c, payload_hash: str, data: List[Dict]):
+    """Adds the items of a new payload to payload_items and the search indexes."""
+    def text(value):
+        return "" if value is None else str(value)
+
+    rows = [
+        (payload_hash, text(item.get('title')), text(item.get('summary')), text(item.get('link')))
+        for item in data if isinstance(item, dict)
+    ]
+    if not rows:
+        return
+    c.executemany("INSERT INTO payload_items (payload_hash, title, summary, link) VALUES (?, ?, ?, ?)", rows)
+    c.execute(
+        "INSERT INTO items_fts (rowid, title, summary, link) "
+        "SELECT id, title, summary, link FROM payload_items WHERE payload_hash = ?",
+        (payload_hash,)
+    )
+    c.executemany("INSERT INTO items_grams (rowid, title, summary, link) VALUES (?, ?, ?, ?)",
+                  _item_grams_rows(c, payload_hash))
+
+def _unindex_payload_items(c, payload_hash: str):
+    """Removes a payload's items from the search indexes and payload_items."""
+    # External-content and contentless FTS5 tables are told which text to remove with a 'delete' row
+    c.executemany("INSERT INTO items_grams (items_grams, rowid, title, summary, link) VALUES ('delete', ?, ?, ?, ?)",
+                  _item_grams_rows(c, payload_hash))
+    c.execute(
+        "INSERT INTO items_fts (items_fts, rowid, title, summary, link) "
+        "SELECT 'delete', id, title, summary, link FROM payload_items WHERE payload_hash = ?",
+        (payload_hash,)
+    )
+    c.execute("DELETE FROM payload_items WHERE payload_hash = ?", (payload_hash,))
+
+def _backfill_items_grams(c, batch_size: int = 500):
+    """Migration 11: indexes the grams of every item already in payload_items."""
+    indexed, last_id = 0, 0
+    while True:
+        c.execute("SELECT id, title, summary, link FROM payload_items WHERE id > ? ORDER BY id LIMIT ?",
+                  (last_id, batch_size))
+        rows = c.fetchall()
+        if not rows:
+            break
+        c.executemany(
+            "INSERT INTO items_grams (rowid, title, summary, link) VALUES (?, ?, ?, ?)",
+            [(row['id'], _item_grams(row['title']), _item_grams(row['summary']), _item_grams(row['link']))
+             for row in rows]
+        )
+        last_id = rows[-1]['id']
+        indexed += len(rows)
+    if indexed:
+        print(f"[DB] Indexed {indexed} item(s) for short-term search")
+
+def _backfill_payload_items(c, batch_size: int = 500):
+    """Migration 10: indexes the items of every stored payload."""
+    indexed, last_rowid = 0, 0
+    while True:
+        c.execute("SELECT rowid, hash, encoding, data FROM payloads WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                  (last_rowid, batch_size))
+        rows = c.fetchall()
+        if not rows:
+            break
+        for row in rows:
+            _index_payload_items(c, row['hash'], json.loads(_decode_payload(row['encoding'], row['data'])))
+        last_rowid = rows[-1]['rowid']
+        indexed += len(rows)
+    if indexed:
+        print(f"[DB] Indexed the items of {indexed} stored payloads for search")
+
+def _decode_payload(encoding: str, blob: bytes) -> str:
+    if encoding == "zlib":
+        return zlib.decompress(blob).decode("utf-8")
+    raise ValueError(f"Unknown payload encoding {encoding}")
+
+def _load_data(conn, row) -> List[Dict]:
+    """Extracted items of a history row: from its payload, or the legacy inline data_json."""
+    if row['payload_hash']:
+        payload = conn.execute(
+            "SELECT encoding, data FROM payloads WHERE hash = ?", (row['payload_hash'],)
+        ).fetchone()
+        if payload:
+            return json.loads(_decode_payload(payload['encoding'], payload['data']))
+    legacy = conn.execute("SELECT data_json FROM history WHERE id = ?", (row['id'],)).fetchone()
+    return json.loads((legacy and legacy['data_json']) or '[]')
+
+def _move_history_payloads(c, batch_size: int = 500):
+    """Migration 7: moves inline data_json into payloads and fills missing content hashes."""
+    moved = 0
+    while True:
+        c.execute("SELECT id, data_json, content_hash FROM history WHERE payload_hash IS NULL AND data_json IS NOT NULL LIMIT ?", (batch_size,))
+        rows = c.fetchall()
+        if not rows:
+            break
+        for row in rows:
+            content_hash = row['content_hash'] or compute_content_hash(json.loads(row['data_json']))
+            _store_payload(c, content_hash, row['data_json'])
+            c.execute(
+                "UPDATE history SET payload_hash = ?, content_hash = ?, data_json = NULL WHERE id = ?",
+                (content_hash, content_hash, row['id'])
+            )
+        moved += len(rows)
+    if moved:
+        print(f"[DB] Moved {moved} history payload(s) to the payloads table")
+
+# Metadata only: list views never read payloads
+HISTORY_COLUMNS = "id, url, topic, summary, timestamp, status, content_hash, payload_hash"
+
+@metrics.timed(QUERY_SECONDS)
+def add_history(url: str, topic: str, data: List[Dict], status: str = "success", content_hash: Optional[str] = None):
+    """
+    Inserts a history row and returns its id. The extracted items go to the
+    content-addressed payloads table, stored once per distinct content.
+    """
     # Create a summary string (e.g., "Found 5 items")
     summary = f"Found {len(data)} items" if data else "No data found"
+    if content_hash is None:
+        content_hash = compute_content_hash(data)
     
-    c.execute(
-        "INSERT INTO history (url, topic, summary, data_json, status) VALUES (?, ?, ?, ?, ?)",
-        (url, topic, summary, json.dumps(data, ensure_ascii=False), status)
+    with transaction() as c:
+        if _store_payload(c, content_hash, json.dumps(data, ensure_ascii=False)):
+            # Only new content is indexed; repeats find it through their payload_hash
+            _index_payload_items(c, content_hash, data)
+        c.execute(
+            "INSERT INTO history (url, topic, summary, status, content_hash, payload_hash) VALUES (?, ?, ?, ?, ?, ?)",
+            (url, topic, summary, status, content_hash, content_hash)
+        )
+        return c.lastrowid
+
+# Columns a caller may request from get_history(fields=...); id and timestamp are always included
+HISTORY_FIELDS = tuple(column.strip() for column in HISTORY_COLUMNS.split(","))
+
+def encode_history_cursor(row: Dict[str, Any]) -> str:
+    """Opaque keyset cursor pointing just past `row` (its timestamp and id)."""
+    return base64.urlsafe_b64encode(f"{row['timestamp']}|{row['id']}".encode()).decode()
+
+def decode_history_cursor(cursor: str):
+    """(timestamp, id) from encode_history_cursor; raises ValueError on a malformed cursor."""
+    try:
+        timestamp, history_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+        return timestamp, int(history_id)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        raise ValueError(f"Invalid history cursor: {cursor!r}")
+
+@metrics.timed(QUERY_SECONDS)
+def get_history(limit: int = 50, cursor: Optional[str] = None, url: Optional[str] = None,
+                status: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                fields: Optional[List[str]] = None):
+    """
+    One page of history, newest first, metadata only (see get_history_entry
+    for the items). Pass the cursor of the previous page's last row
+    (encode_history_cursor) to continue after it; pages are keyset ranges on
+    (timestamp, id), so deep pages cost the same as the first one.
+    `since` is inclusive and `until` exclusive; both compare against the
+    stored timestamp text ("2024-05-01" or "2024-05-01 08:00:00").
+    """
+    columns = HISTORY_COLUMNS
+    if fields:
+        unknown = [field for field in fields if field not in HISTORY_FIELDS]
+        if unknown:
+            raise ValueError(f"Unknown history field(s): {', '.join(unknown)}")
+        columns = ", ".join(field for field in HISTORY_FIELDS
+                            if field in fields or field in ("id", "timestamp"))
+
+    conditions, params = [], []
+    if url:
+        conditions.append("url = ?")
+        params.append(url)
+    if status:
+        conditions.append("status = ?")
+        params.append(status)
+    if since:
+        conditions.append("timestamp >= ?")
+        params.append(since)
+    if until:
+        conditions.append("timestamp < ?")
+        params.append(until)
+    if cursor:
+        conditions.append("(timestamp, id) < (?, ?)")
+        params.extend(decode_history_cursor(cursor))
+
+    query = f"SELECT {columns} FROM history"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    rows = get_connection().execute(query + " ORDER BY timestamp DESC, id DESC LIMIT ?", params + [limit]).fetchall()
+    return [dict(row) for row in rows]
+
+@metrics.timed(QUERY_SECONDS)
+def get_history_entry(history_id: int):
+    """One history row with its extracted items under 'data', or None."""
+    conn = get_connection()
+    row = conn.execute(f"SELECT {HISTORY_COLUMNS} FROM history WHERE id = ?", (history_id,)).fetchone()
+    if not row:
+        return None
+    entry = dict(row)
+    entry['data'] = _load_data(conn, row)
+    return entry
+
+def iter_history_export(url: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                        batch_size: int = EXPORT_BATCH_SIZE):
+    """
+    Yields every matching history row, oldest first, with its items decoded
+    under 'data'. Rows are read batch_size at a time from one cursor on a
+    dedicated connection (usable from any thread, as a streaming response
+    needs), so memory stays flat however large the export. Filters match
+    get_history(). The export sees one consistent snapshot of the table.
+    """
+    conditions, params = [], []
+    if url:
+        conditions.append("h.url = ?")
+        params.append(url)
+    if since:
+        conditions.append("h.timestamp >= ?")
+        params.append(since)
+    if until:
+        conditions.append("h.timestamp < ?")
+        params.append(until)
+    query = (
+        "SELECT h.id, h.url, h.topic, h.summary, h.timestamp, h.status, h.content_hash, h.payload_hash,"
+        " p.encoding, p.data, CASE WHEN p.hash IS NULL THEN h.data_json END AS data_json"
+        " FROM history h LEFT JOIN payloads p ON p.hash = h.payload_hash"
     )
-    conn.commit()
-    conn.close()
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += " ORDER BY h.timestamp, h.id"
+
+    conn = open_connection(check_same_thread=False)
+    try:
+        cursor = conn.execute(query, params)
+        # Consecutive unchanged runs share a payload; decode it once
+        last_hash, last_data = None, None
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                entry = {column: row[column] for column in HISTORY_FIELDS if column != 'payload_hash'}
+                if row['encoding'] is not None:
+                    if row['payload_hash'] != last_hash:
+                        last_hash = row['payload_hash']
+                        last_data = json.loads(_decode_payload(row['encoding'], row['data']))
+                    entry['data'] = last_data
+                else:
+                    entry['data'] = json.loads(row['data_json'] or '[]')
+                yield entry
+    finally:
+        conn.close()
 
-def get_history(limit: int = 50):
+def _fts_phrase(terms: List[str]) -> str:
+    # Quoted terms are matched literally; FTS5 query syntax in user input is not interpreted
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+@metrics.timed(QUERY_SECONDS)
+def search_items(query: str, url: Optional[str] = None, limit: int = 20, offset: int = 0):
+    """
+    Extracted items whose title, summary or link contain every word of
+    `query`, best bm25 match first (title weighs most). Each distinct item is
+    returned once per URL with when it was first and last seen and the latest
+    history row that had it. Words of 3+ characters are looked up in the
+    trigram index (items_fts); shorter ones, such as two-character Chinese
+    words, in the unigram/bigram index (items_grams), which only holds
+    letters and digits, so other characters in a short word are ignored.
+    """
+    terms = query.split()
+    long_terms = [term for term in terms if len(term) >= 3]
+    # A short word is itself one gram of items_grams, so each is a single token match
+    short_grams = ["".join(_ITEM_GRAM_RUN.findall(term.lower())) for term in terms if len(term) < 3]
+    grams_match = _fts_phrase([gram for gram in short_grams if gram])
+    if not long_terms and not grams_match:
+        return []
     conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM history ORDER BY timestamp DESC LIMIT ?", (limit,))
-    rows = c.fetchall()
-    conn.close()
+    if long_terms:
+        match = "items_fts MATCH ?"
+        match_params = [_fts_phrase(long_terms)]
+        if grams_match:
+            match += " AND rowid IN (SELECT rowid FROM items_grams WHERE items_grams MATCH ?)"
+            match_params.append(grams_match)
+        source, score = "items_fts", "bm25(items_fts, 10.0, 5.0, 1.0)"
+    else:
+        match, match_params = "items_grams MATCH ?", [grams_match]
+        source, score = "items_grams", "bm25(items_grams, 10.0, 5.0, 1.0)"
+
+    params = list(match_params)
+    url_filter = ""
+    if url:
+        url_filter = "WHERE h.url = ?"
+        params.append(url)
+    rows = conn.execute(
+        # MATERIALIZED keeps bm25() inside the FTS query rather than flattened into the joins
+        "WITH hits AS MATERIALIZED ("
+        f" SELECT rowid AS item_id, {score} AS score FROM {source} WHERE {match})"
+        " SELECT h.url, i.title, i.summary, i.link, MIN(hits.score) AS score,"
+        " MIN(h.timestamp) AS first_seen, MAX(h.timestamp) AS last_seen, MAX(h.id) AS history_id"
+        " FROM hits JOIN payload_items i ON i.id = hits.item_id"
+        " JOIN history h ON h.payload_hash = i.payload_hash"
+        f" {url_filter}"
+        " GROUP BY h.url, i.title, i.summary, i.link"
+        " ORDER BY score, last_seen DESC LIMIT ? OFFSET ?",
+        params + [limit, offset]
+    ).fetchall()
     return [dict(row) for row in rows]
 
+@metrics.timed(QUERY_SECONDS)
 def get_last_history_for_url(url: str):
     """
-    Retrieves the most recent history entry for a specific URL.
+    Retrieves the most recent history entry for a specific URL, with its items under 'data'.
     Used for detecting duplicate manual checks.
     """
     conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM history WHERE url = ? ORDER BY timestamp DESC LIMIT 1", (url,))
-    row = c.fetchone()
-    conn.close()
+    row = conn.execute(
+        f"SELECT {HISTORY_COLUMNS} FROM history WHERE url = ? ORDER BY timestamp DESC LIMIT 1", (url,)
+    ).fetchone()
     if row:
-        return dict(row)
+        entry = dict(row)
+        entry['data'] = _load_data(conn, row)
+        return entry
     return None
 
-def add_schedule(url: str, topic: str, email: str, frequency_days: int, scraper_type: str = "AI", unit: str = "days", is_continuous: bool = True):
+@metrics.timed(QUERY_SECONDS)
+def get_last_history_digest(url: str):
+    """
+    Returns {'id', 'content_hash', 'timestamp'} of the most recent history entry
+    for a URL, or None. Only rows without a stored hash load their items.
+    """
     conn = get_connection()
-    c = conn.cursor()
-    
-    # IMPORTANT: Deactivate any existing active schedule for the same URL+Email to prevent duplicates
-    c.execute(
-        "UPDATE schedules SET is_active = 0 WHERE url = ? AND email = ? AND is_active = 1",
-        (url, email)
-    )
-    deactivated = c.rowcount
-    if deactivated > 0:
-        print(f"[DB] Deactivated {deactivated} existing schedule(s) for {url}")
-    
+    row = conn.execute(
+        "SELECT id, content_hash, payload_hash, timestamp FROM history WHERE url = ? ORDER BY timestamp DESC, id DESC LIMIT 1", (url,)
+    ).fetchone()
+    if not row:
+        return None
+    digest = {"id": row['id'], "content_hash": row['content_hash'], "timestamp": row['timestamp']}
+    if digest['content_hash'] is None:
+        digest['content_hash'] = compute_content_hash(_load_data(conn, row))
+    return digest
+
+@metrics.timed(QUERY_SECONDS)
+def apply_item_delta(url: str, history_id: int, data: List[Dict]):
+    """
+    Diffs the extracted items against the URL's item index, updates the index
+    with only the changed entries and records the delta for the history row.
+    Returns {'added', 'modified', 'removed'} lists of items.
+    """
+    import item_diff
+
+    with transaction() as c:
+        c.execute("SELECT item_key, fingerprint, item_json FROM item_index WHERE url = ?", (url,))
+        index = {
+            row['item_key']: {"fingerprint": row['fingerprint'], "item": json.loads(row['item_json'])}
+            for row in c.fetchall()
+        }
+        diff = item_diff.diff_items(index, data)
+
+        for key, entry in diff['upserts'].items():
+            c.execute(
+                "INSERT INTO item_index (url, item_key, fingerprint, item_json) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(url, item_key) DO UPDATE SET fingerprint = excluded.fingerprint, "
+                "item_json = excluded.item_json, updated_at = datetime('now')",
+                (url, key, entry['fingerprint'], json.dumps(entry['item'], ensure_ascii=False))
+            )
+        c.executemany(
+            "DELETE FROM item_index WHERE url = ? AND item_key = ?",
+            [(url, key) for key in diff['deletes']]
+        )
+
+        delta = {name: diff[name] for name in ("added", "modified", "removed")}
+        if any(delta.values()):
+            c.execute(
+                "INSERT OR REPLACE INTO history_delta (history_id, added, modified, removed, delta_json) VALUES (?, ?, ?, ?, ?)",
+                (history_id, len(delta['added']), len(delta['modified']), len(delta['removed']),
+                 json.dumps(delta, ensure_ascii=False))
+            )
+    return delta
+
+@metrics.timed(QUERY_SECONDS)
+def get_history_delta(history_id: int):
+    """Returns the stored {'added', 'modified', 'removed'} delta of a history row, or None."""
+    row = get_connection().execute(
+        "SELECT delta_json FROM history_delta WHERE history_id = ?", (history_id,)
+    ).fetchone()
+    if row:
+        return json.loads(row['delta_json'])
+    return None
+
+@metrics.timed(QUERY_SECONDS)
+def add_schedule(url: str, topic: str, email: str, frequency_days: int, scraper_type: str = "AI", unit: str = "days", is_continuous: bool = True):
     # Calculate next_run based on frequency and unit
     if unit == 'minutes':
         next_run_expr = f"datetime('now', '+{frequency_days} minutes')"
     else:
         next_run_expr = f"datetime('now', '+{frequency_days} days')"
     
-    c.execute(
-        f"INSERT INTO schedules (url, topic, email, frequency_days, scraper_type, unit, next_run, is_continuous) VALUES (?, ?, ?, ?, ?, ?, {next_run_expr}, ?)",
-        (url, topic, email, frequency_days, scraper_type, unit, 1 if is_continuous else 0)
-    )
-    schedule_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        # IMPORTANT: Deactivate any existing active schedule for the same URL+Email to prevent duplicates
+        c.execute(
+            "UPDATE schedules SET is_active = 0 WHERE url = ? AND email = ? AND is_active = 1",
+            (url, email)
+        )
+        deactivated = c.rowcount
+        if deactivated > 0:
+            print(f"[DB] Deactivated {deactivated} existing schedule(s) for {url}")
+        
+        c.execute(
+            f"INSERT INTO schedules (url, topic, email, frequency_days, scraper_type, unit, next_run, is_continuous) VALUES (?, ?, ?, ?, ?, ?, {next_run_expr}, ?)",
+            (url, topic, email, frequency_days, scraper_type, unit, 1 if is_continuous else 0)
+        )
+        schedule_id = c.lastrowid
     return schedule_id
 
+@metrics.timed(QUERY_SECONDS)
 def get_due_schedules():
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM schedules WHERE is_active = 1 AND next_run <= datetime('now')")
-    rows = c.fetchall()
-    conn.close()
+    rows = get_connection().execute(
+        "SELECT * FROM schedules WHERE is_active = 1 AND next_run <= datetime('now')"
+    ).fetchall()
     return [dict(row) for row in rows]
 
+@metrics.timed(QUERY_SECONDS)
 def update_schedule_next_run(schedule_id: int, flow_val: int, unit: str = "days"):
-    conn = get_connection()
-    c = conn.cursor()
-    
     # If unit is 'minutes', add flow_val minutes.
     # Otherwise add flow_val days.
     
@@ -152,39 +782,341 @@ def update_schedule_next_run(schedule_id: int, flow_val: int, unit: str = "days"
          else:
              time_expr = f"datetime('now', '+{flow_val} days')"
 
-    c.execute(
-        f"UPDATE schedules SET last_run = datetime('now'), next_run = {time_expr} WHERE id = ?",
-        (schedule_id,)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        c.execute(
+            f"UPDATE schedules SET last_run = datetime('now'), next_run = {time_expr} WHERE id = ?",
+            (schedule_id,)
+        )
+        c.execute("SELECT next_run FROM schedules WHERE id = ?", (schedule_id,))
+        row = c.fetchone()
+    return row['next_run'] if row else None
 
+@metrics.timed(QUERY_SECONDS)
 def toggle_schedule_active(schedule_id: int, is_active: bool):
     """Toggle the is_active status of a schedule."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute(
-        "UPDATE schedules SET is_active = ? WHERE id = ?",
-        (1 if is_active else 0, schedule_id)
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as c:
+        c.execute(
+            "UPDATE schedules SET is_active = ? WHERE id = ?",
+            (1 if is_active else 0, schedule_id)
+        )
 
+@metrics.timed(QUERY_SECONDS)
+def get_schedule(schedule_id: int):
+    """Get a single schedule by id, or None."""
+    row = get_connection().execute("SELECT * FROM schedules WHERE id = ?", (schedule_id,)).fetchone()
+    if row:
+        return dict(row)
+    return None
+
+@metrics.timed(QUERY_SECONDS)
 def get_active_schedules():
     """Get all active schedules."""
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT * FROM schedules WHERE is_active = 1 ORDER BY next_run ASC")
-    rows = c.fetchall()
-    conn.close()
+    rows = get_connection().execute("SELECT * FROM schedules WHERE is_active = 1 ORDER BY next_run ASC").fetchall()
     return [dict(row) for row in rows]
 
+@metrics.timed(QUERY_SECONDS)
 def deactivate_all_schedules():
     """Deactivate all schedules. Returns the number of schedules affected."""
+    with transaction() as c:
+        c.execute("UPDATE schedules SET is_active = 0 WHERE is_active = 1")
+        count = c.rowcount
+    return count
+
+@metrics.timed(QUERY_SECONDS)
+def get_fetch_cache(url: str):
+    """Returns the cached validators (etag, last_modified), schema_hash and parsed data for a URL, or None."""
+    row = get_connection().execute(
+        "SELECT etag, last_modified, data_json, schema_hash FROM fetch_cache WHERE url = ?", (url,)
+    ).fetchone()
+    if not row:
+        return None
+    entry = dict(row)
+    entry['data'] = json.loads(entry.pop('data_json') or '[]')
+    return entry
+
+@metrics.timed(QUERY_SECONDS)
+def save_fetch_cache(url: str, etag: Optional[str], last_modified: Optional[str], data: List[Dict], schema_hash: Optional[str] = None):
+    """Stores the validators and extracted result of the latest 200 response for a URL."""
+    with transaction() as c:
+        c.execute(
+            "INSERT OR REPLACE INTO fetch_cache (url, etag, last_modified, data_json, schema_hash, updated_at) VALUES (?, ?, ?, ?, ?, datetime('now'))",
+            (url, etag, last_modified, json.dumps(data, ensure_ascii=False), schema_hash)
+        )
+
+@metrics.timed(QUERY_SECONDS)
+def enqueue_outbound(idempotency_key: str, to_email: str, subject: str, body: str):
+    """
+    Queues a rendered email for delivery. Returns the new row id, or None when
+    a message with the same idempotency key was queued before.
+    """
+    with transaction() as c:
+        c.execute(
+            "INSERT OR IGNORE INTO outbound_queue (idempotency_key, to_email, subject, body) VALUES (?, ?, ?, ?)",
+            (idempotency_key, to_email, subject, body)
+        )
+        return c.lastrowid if c.rowcount else None
+
+@metrics.timed(QUERY_SECONDS)
+def claim_outbound(limit: int = 20):
+    """Marks up to `limit` due pending messages as sending (one attempt each) and returns them."""
+    # One UPDATE ... RETURNING (SQLite 3.35+) so concurrent workers never claim the same row
+    with transaction() as c:
+        c.execute(
+            "UPDATE outbound_queue SET status = 'sending', attempts = attempts + 1 WHERE id IN ("
+            "SELECT id FROM outbound_queue WHERE status = 'pending' AND next_attempt_at <= datetime('now') "
+            "ORDER BY next_attempt_at LIMIT ?) RETURNING *",
+            (limit,)
+        )
+        rows = [dict(row) for row in c.fetchall()]
+    return sorted(rows, key=lambda row: row['id'])
+
+@metrics.timed(QUERY_SECONDS)
+def mark_outbound_sent(message_id: int):
+    with transaction() as c:
+        c.execute(
+            "UPDATE outbound_queue SET status = 'sent', sent_at = datetime('now'), last_error = NULL WHERE id = ?",
+            (message_id,)
+        )
+
+@metrics.timed(QUERY_SECONDS)
+def mark_outbound_failed(message_id: int, error: str, retry_in_seconds: Optional[float] = None):
+    """Schedules another attempt after `retry_in_seconds`, or dead-letters the message when it is None."""
+    with transaction() as c:
+        if retry_in_seconds is None:
+            c.execute(
+                "UPDATE outbound_queue SET status = 'dead', last_error = ? WHERE id = ?", (error, message_id)
+            )
+        else:
+            c.execute(
+                "UPDATE outbound_queue SET status = 'pending', last_error = ?, "
+                "next_attempt_at = datetime('now', ?) WHERE id = ?",
+                (error, f"+{int(retry_in_seconds)} seconds", message_id)
+            )
+
+@metrics.timed(QUERY_SECONDS)
+def requeue_stale_outbound():
+    """Returns messages left in 'sending' by a crashed process to the queue. Returns the count."""
+    with transaction() as c:
+        c.execute("UPDATE outbound_queue SET status = 'pending' WHERE status = 'sending'")
+        return c.rowcount
+
+@metrics.timed(QUERY_SECONDS)
+def get_outbound_stats():
+    """Message count per status."""
+    rows = get_connection().execute("SELECT status, COUNT(*) AS count FROM outbound_queue GROUP BY status").fetchall()
+    return {row['status']: row['count'] for row in rows}
+
+@metrics.timed(QUERY_SECONDS)
+def get_dead_outbound(limit: int = 50):
+    """Most recent dead-lettered messages, without their bodies."""
+    rows = get_connection().execute(
+        "SELECT id, idempotency_key, to_email, subject, attempts, last_error, created_at "
+        "FROM outbound_queue WHERE status = 'dead' ORDER BY next_attempt_at DESC LIMIT ?",
+        (limit,)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+@metrics.timed(QUERY_SECONDS)
+def retry_dead_outbound(message_id: int):
+    """Puts a dead-lettered message back in the queue with a fresh attempt budget. Returns True if found."""
+    with transaction() as c:
+        c.execute(
+            "UPDATE outbound_queue SET status = 'pending', attempts = 0, next_attempt_at = datetime('now') "
+            "WHERE id = ? AND status = 'dead'",
+            (message_id,)
+        )
+        return c.rowcount > 0
+
+@metrics.timed(QUERY_SECONDS)
+def add_digest_item(idempotency_key: str, to_email: str, url: str, subject: str, updates: List[Dict]):
+    """Holds one scheduled result for the recipient's next digest. Returns its id, or None if the key was seen before."""
+    with transaction() as c:
+        c.execute(
+            "INSERT OR IGNORE INTO digest_items (idempotency_key, to_email, url, subject, updates_json) VALUES (?, ?, ?, ?, ?)",
+            (idempotency_key, to_email, url, subject, json.dumps(updates, ensure_ascii=False))
+        )
+        return c.lastrowid if c.rowcount else None
+
+@metrics.timed(QUERY_SECONDS)
+def get_due_digest_recipients(window_seconds: int):
+    """Recipients whose oldest pending digest item is at least `window_seconds` old."""
+    rows = get_connection().execute(
+        "SELECT to_email FROM digest_items WHERE outbound_id IS NULL GROUP BY to_email "
+        "HAVING MIN(created_at) <= datetime('now', ?)",
+        (f"-{int(window_seconds)} seconds",)
+    ).fetchall()
+    return [row['to_email'] for row in rows]
+
+@metrics.timed(QUERY_SECONDS)
+def get_pending_digest_items(to_email: str):
+    """Pending digest items for a recipient, oldest first, with `updates` decoded."""
+    rows = get_connection().execute(
+        "SELECT id, url, subject, updates_json, created_at FROM digest_items "
+        "WHERE to_email = ? AND outbound_id IS NULL ORDER BY created_at, id",
+        (to_email,)
+    ).fetchall()
+    items = []
+    for row in rows:
+        item = dict(row)
+        item['updates'] = json.loads(item.pop('updates_json'))
+        items.append(item)
+    return items
+
+@metrics.timed(QUERY_SECONDS)
+def flush_digest(item_ids: List[int], idempotency_key: str, to_email: str, subject: str, body: str):
+    """
+    Queues the rendered digest and marks its items as sent in one transaction,
+    so a crash can neither lose the items nor send them twice. Returns the outbound id.
+    """
+    with transaction() as c:
+        c.execute(
+            "INSERT OR IGNORE INTO outbound_queue (idempotency_key, to_email, subject, body) VALUES (?, ?, ?, ?)",
+            (idempotency_key, to_email, subject, body)
+        )
+        c.execute("SELECT id FROM outbound_queue WHERE idempotency_key = ?", (idempotency_key,))
+        outbound_id = c.fetchone()['id']
+        c.executemany(
+            "UPDATE digest_items SET outbound_id = ? WHERE id = ?", [(outbound_id, item_id) for item_id in item_ids]
+        )
+    return outbound_id
+
+@metrics.timed(QUERY_SECONDS)
+def rollup_history_daily():
+    """
+    Summarizes every complete day after the last rolled-up one into
+    history_daily. Returns the number of (day, url) rows written.
+    """
+    with transaction() as c:
+        c.execute("SELECT MAX(day) AS day FROM history_daily")
+        last_day = c.fetchone()['day'] or "0000-01-01"
+        c.execute(
+            "INSERT OR REPLACE INTO history_daily (day, url, runs, failures, changes, items) "
+            "SELECT date(h.timestamp), h.url, COUNT(*), "
+            "SUM(CASE WHEN h.status = 'failed' THEN 1 ELSE 0 END), "
+            "COUNT(d.history_id), COALESCE(SUM(d.added + d.modified), 0) "
+            "FROM history h LEFT JOIN history_delta d ON d.history_id = h.id "
+            "WHERE h.timestamp >= datetime(?, '+1 day') AND h.timestamp < date('now') "
+            "GROUP BY date(h.timestamp), h.url",
+            (last_day,)
+        )
+        return c.rowcount
+
+@metrics.timed(QUERY_SECONDS)
+def get_history_daily(url: Optional[str] = None, days: int = 30):
+    """Daily run statistics for the last `days` days, newest first, optionally for one URL."""
+    query = "SELECT day, url, runs, failures, changes, items FROM history_daily WHERE day >= date('now', ?)"
+    params: list = [f"-{int(days)} days"]
+    if url:
+        query += " AND url = ?"
+        params.append(url)
+    rows = get_connection().execute(query + " ORDER BY day DESC, url", params).fetchall()
+    return [dict(row) for row in rows]
+
+@metrics.timed(QUERY_SECONDS)
+def find_prunable_history(keep_last: int, repeat_days: int, after=None, limit: int = 500):
+    """
+    Walks history rows older than `repeat_days` in (timestamp, id) order,
+    `limit` rows per call starting after the `after` cursor, and returns
+    (ids, cursor). ids are the rows the retention policy may drop: outside
+    the newest `keep_last` rows of their URL and with the same content as the
+    row before them (changes are always kept). cursor is the last row
+    examined, or None once the walk has reached the cutoff. Each row costs
+    two index seeks, so a call never touches more than `limit` rows' worth.
+    """
+    query = (
+        "SELECT h.id, h.timestamp, h.content_hash,"
+        " (SELECT p.content_hash FROM history p WHERE p.url = h.url AND (p.timestamp, p.id) < (h.timestamp, h.id)"
+        "  ORDER BY p.timestamp DESC, p.id DESC LIMIT 1) AS previous_hash,"
+        # Non-NULL when at least keep_last newer rows of the same URL exist
+        " (SELECT n.id FROM history n WHERE n.url = h.url AND (n.timestamp, n.id) > (h.timestamp, h.id)"
+        "  ORDER BY n.timestamp, n.id LIMIT 1 OFFSET ?) AS newer"
+        " FROM history h WHERE h.timestamp < datetime('now', ?)"
+    )
+    params: list = [max(keep_last - 1, 0), f"-{int(repeat_days)} days"]
+    if after:
+        query += " AND (h.timestamp, h.id) > (?, ?)"
+        params.extend(after)
+    rows = get_connection().execute(query + " ORDER BY h.timestamp, h.id LIMIT ?", params + [limit]).fetchall()
+    ids = [
+        row['id'] for row in rows
+        if row['newer'] is not None and row['content_hash'] and row['previous_hash'] == row['content_hash']
+    ]
+    cursor = (rows[-1]['timestamp'], rows[-1]['id']) if len(rows) == limit else None
+    return ids, cursor
+
+@metrics.timed(QUERY_SECONDS)
+def delete_history_rows(history_ids: List[int]):
+    """
+    Deletes history rows and their deltas, then the payloads (with their
+    search entries) that only those rows referenced. Only the payloads of the
+    deleted rows are checked, one index seek each. Returns (history rows
+    removed, payloads removed).
+    """
+    params = [(history_id,) for history_id in history_ids]
+    with transaction() as c:
+        placeholders = ", ".join("?" * len(history_ids))
+        c.execute(
+            f"SELECT DISTINCT payload_hash FROM history WHERE id IN ({placeholders}) AND payload_hash IS NOT NULL",
+            history_ids
+        )
+        payload_hashes = [row['payload_hash'] for row in c.fetchall()]
+        c.executemany("DELETE FROM history_delta WHERE history_id = ?", params)
+        c.executemany("DELETE FROM history WHERE id = ?", params)
+        removed = c.rowcount
+        return removed, _delete_orphan_payloads(c, payload_hashes)
+
+def _delete_orphan_payloads(c, payload_hashes: List[str]) -> int:
+    """Deletes those of the given payloads no history row references any more. Returns the count."""
+    deleted = 0
+    for payload_hash in payload_hashes:
+        c.execute("SELECT 1 FROM history WHERE payload_hash = ? LIMIT 1", (payload_hash,))
+        if c.fetchone():
+            continue
+        _unindex_payload_items(c, payload_hash)
+        c.execute("DELETE FROM payloads WHERE hash = ?", (payload_hash,))
+        deleted += 1
+    return deleted
+
+@metrics.timed(QUERY_SECONDS)
+def purge_delivered_notifications(days: int):
+    """Drops sent emails, and the digest items they carried, older than `days`. Returns the emails removed."""
+    cutoff = f"-{int(days)} days"
+    with transaction() as c:
+        c.execute(
+            "DELETE FROM digest_items WHERE outbound_id IN ("
+            "SELECT id FROM outbound_queue WHERE status = 'sent' AND sent_at < datetime('now', ?))",
+            (cutoff,)
+        )
+        c.execute("DELETE FROM outbound_queue WHERE status = 'sent' AND sent_at < datetime('now', ?)", (cutoff,))
+        return c.rowcount
+
+@metrics.timed(QUERY_SECONDS)
+def incremental_vacuum(pages: int):
+    """
+    Returns up to `pages` free pages to the filesystem. Returns the free pages
+    left, or 0 if the file is not in incremental auto-vacuum mode (nothing
+    can be returned until it is converted).
+    """
     conn = get_connection()
-    c = conn.cursor()
-    c.execute("UPDATE schedules SET is_active = 0 WHERE is_active = 1")
-    count = c.rowcount
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        return 0
+    # incremental_vacuum only does its work while the result rows are stepped
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
     conn.commit()
-    conn.close()
-    return count
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+@metrics.timed(QUERY_SECONDS)
+def enable_incremental_vacuum():
+    """
+    Switches an existing database to auto_vacuum=INCREMENTAL. Needs one full
+    VACUUM, which rewrites the file and blocks writers while it runs, so it
+    is only run on request (python retention.py --convert-auto-vacuum).
+    Returns True if a conversion was done.
+    """
+    conn = get_connection()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    conn.commit()
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
@@ -1,7 +1,7 @@
 
 import time
 import scraper_css
-import requests
+import http_client
 
 def test_speed(url):
     print(f"Testing fetch for: {url}")
@@ -18,5 +18,7 @@ def test_speed(url):
         print(f"Exception: {e}")
 
 if __name__ == "__main__":
-    # Test valid URL
+    # Test valid URL (second call should reuse the pooled keep-alive connection)
     test_speed("https://www.roccrane.org.tw/news")
+    test_speed("https://www.roccrane.org.tw/news")
+    print(f"Connection stats: {http_client.get_stats()}")
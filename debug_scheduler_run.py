@@ -1,5 +1,6 @@
 import scheduler
 import database
+import outbox
 import time
 
 def test_run():
@@ -15,11 +16,12 @@ def test_run():
     print(f"Current Schedules: {len(rows)}")
     for r in rows:
         print(dict(r))
-    conn.close()
 
     print("Running check_and_run_jobs()...")
     try:
-        scheduler.check_and_run_jobs()
+        scheduler.check_and_run_jobs(wait=True)
+        # No outbox workers in this script: deliver the queued emails here
+        outbox.drain()
         print("Scheduler run finish.")
     except Exception as e:
         print(f"SCHEDULER CRASH: {e}")
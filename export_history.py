@@ -0,0 +1,108 @@
+"""
+Bulk export of extraction history as NDJSON or CSV.
+
+Both formats are produced by generators over database.iter_history_export,
+so an export of any size runs in constant memory; api.py streams the same
+generators from /api/history/export.
+
+    ndjson  one history row per line, its items under "data"
+    csv     one line per extracted item (a run without items still gets
+            one line, with the item columns empty)
+
+Usage:
+    python export_history.py [--format ndjson|csv] [--url URL]
+                             [--since 2024-05-01] [--until 2024-06-01]
+                             [--output history.ndjson]
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+
+import database
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv; charset=utf-8",
+}
+
+# Run columns, then the fields the default schema outputs for each item
+CSV_COLUMNS = ["history_id", "url", "topic", "timestamp", "status", "item_index",
+               "date", "title", "summary", "link", "source"]
+ITEM_FIELDS = CSV_COLUMNS[6:]
+
+# Output is handed on in chunks of about this many characters
+CHUNK_CHARS = 64 * 1024
+
+
+def iter_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+def iter_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for row in rows:
+        run = [row["id"], row["url"], row["topic"], row["timestamp"], row["status"]]
+        items = row["data"] or [None]
+        for index, item in enumerate(items):
+            if isinstance(item, dict):
+                writer.writerow(run + [index] + [item.get(field, "") for field in ITEM_FIELDS])
+            else:
+                writer.writerow(run + [""] * (len(ITEM_FIELDS) + 1))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def chunked(parts, size: int = CHUNK_CHARS):
+    """Joins small strings into chunks of about `size` characters."""
+    pending, length = [], 0
+    for part in parts:
+        pending.append(part)
+        length += len(part)
+        if length >= size:
+            yield "".join(pending)
+            pending, length = [], 0
+    if pending:
+        yield "".join(pending)
+
+
+def export(fmt: str = "ndjson", url=None, since=None, until=None):
+    """Generator of output chunks for one export; raises ValueError for an unknown format."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}, expected one of: {', '.join(FORMATS)}")
+    rows = database.iter_history_export(url=url, since=since, until=until)
+    return chunked(iter_csv(rows) if fmt == "csv" else iter_ndjson(rows))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--format", choices=list(FORMATS), default="ndjson")
+    parser.add_argument("--url", help="only this URL")
+    parser.add_argument("--since", help="from this date/time (inclusive)")
+    parser.add_argument("--until", help="up to this date/time (exclusive)")
+    parser.add_argument("--output", help="file to write (default: stdout)")
+    args = parser.parse_args()
+
+    if args.output:
+        out = open(args.output, "w", encoding="utf-8", newline="")
+    else:
+        # Items are mostly Chinese text; never fall back to the console code page
+        sys.stdout.reconfigure(encoding="utf-8", newline="")
+        out = sys.stdout
+    try:
+        for chunk in export(args.format, url=args.url, since=args.since, until=args.until):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
+    if args.output:
+        print(f"History exported to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
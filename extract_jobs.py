@@ -0,0 +1,80 @@
+import os
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+import extraction
+
+# Background manual extractions: worker cap, backlog cap and how long finished jobs stay queryable
+MAX_WORKERS = int(os.getenv("EXTRACT_MAX_WORKERS", "4"))
+MAX_PENDING = int(os.getenv("EXTRACT_MAX_PENDING", "50"))
+JOB_TTL_SECONDS = int(os.getenv("EXTRACT_JOB_TTL_SECONDS", "3600"))
+
+TERMINAL_STATES = ("succeeded", "failed")
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="extract-job")
+_lock = threading.Lock()
+_jobs: Dict[str, Dict[str, Any]] = {}
+
+
+class JobQueueFull(Exception):
+    """Too many extraction jobs are queued or running."""
+
+
+def _update(job_id: str, **fields):
+    with _lock:
+        _jobs[job_id].update(fields)
+
+
+def _run(job_id: str, url: str, email: Optional[str]):
+    _update(job_id, status="running", started_at=time.time())
+    try:
+        result = extraction.run_manual_extraction(url, email)
+        _update(job_id, status="succeeded", result=result, finished_at=time.time())
+    except extraction.ExtractionError as e:
+        _update(job_id, status="failed", error=f"Extraction Failed: {e}", finished_at=time.time())
+    except Exception as e:
+        traceback.print_exc()
+        _update(job_id, status="failed", error=f"Critical Server Error: {e}", finished_at=time.time())
+
+
+def _prune():
+    """Drops finished jobs older than JOB_TTL_SECONDS. Caller holds _lock."""
+    cutoff = time.time() - JOB_TTL_SECONDS
+    expired = [job_id for job_id, job in _jobs.items()
+               if job['status'] in TERMINAL_STATES and job['finished_at'] < cutoff]
+    for job_id in expired:
+        del _jobs[job_id]
+
+
+def submit(url: str, email: Optional[str] = None) -> Dict[str, Any]:
+    """Queues a manual extraction and returns its job snapshot immediately."""
+    job_id = uuid.uuid4().hex
+    with _lock:
+        _prune()
+        pending = sum(1 for job in _jobs.values() if job['status'] not in TERMINAL_STATES)
+        if pending >= MAX_PENDING:
+            raise JobQueueFull(f"{pending} extraction jobs already pending")
+        _jobs[job_id] = {
+            "id": job_id,
+            "url": url,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+    _executor.submit(_run, job_id, url, email)
+    print(f"[Jobs] Queued extraction {job_id} for {url}")
+    return get(job_id)
+
+
+def get(job_id: str) -> Optional[Dict[str, Any]]:
+    """Returns a copy of the job state, or None if unknown or expired."""
+    with _lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job else None
@@ -0,0 +1,189 @@
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+import database
+import item_diff
+import scraper_css
+
+# Callers asking for the same URL within this many seconds of a finished
+# fetch reuse its result instead of fetching again.
+COALESCE_WINDOW_SECONDS = float(os.getenv("FETCH_COALESCE_WINDOW_SECONDS", "5"))
+
+
+class ExtractionError(Exception):
+    """The page could not be fetched or no items were extracted."""
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[Dict[str, Any]] = None
+        self.finished_at: Optional[float] = None
+
+
+_flights: Dict[str, _Flight] = {}
+_flights_lock = threading.Lock()
+
+
+def _fetch_and_record(url: str, status: str, failure_status: Optional[str]) -> Dict[str, Any]:
+    data, error, not_modified = scraper_css.fetch_data_conditional(url)
+    result = {
+        "data": data,
+        "error": error,
+        "not_modified": not_modified,
+        "is_duplicate": False,
+        "previous_timestamp": None,
+        "history_id": None,
+        "delta": item_diff.empty_delta(),
+    }
+
+    if error:
+        if failure_status:
+            try:
+                database.add_history(url, "Auto-CSS", [], status=failure_status)
+            except Exception as e:
+                print(f"[DB Error] Failed to log failure: {e}")
+        return result
+
+    # Compare content digests with the previous run (304 Not Modified is a duplicate by definition)
+    content_hash = database.compute_content_hash(data)
+    try:
+        last_digest = database.get_last_history_digest(url)
+        if last_digest:
+            result["previous_timestamp"] = last_digest['timestamp']
+            result["is_duplicate"] = not_modified or last_digest['content_hash'] == content_hash
+    except Exception as e:
+        print(f"[Extraction] Duplicate check failed for {url}: {e}")
+
+    if result["is_duplicate"]:
+        print(f"[Extraction] Duplicate content detected for {url}")
+
+    try:
+        history_id = database.add_history(url, "Auto-CSS", data, status=status, content_hash=content_hash)
+        result["history_id"] = history_id
+        # Identical content cannot change the item index, so only diff real changes
+        if not result["is_duplicate"]:
+            result["delta"] = database.apply_item_delta(url, history_id, data)
+            delta = result["delta"]
+            print(f"[Extraction] {url}: {len(delta['added'])} added, {len(delta['modified'])} modified, {len(delta['removed'])} removed")
+    except Exception as e:
+        print(f"[DB Error] Failed to save history: {e}")
+
+    return result
+
+
+def check_url(url: str, status: str = "success", failure_status: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Fetches and parses a URL, compares it with the last history entry and
+    records exactly one history row, coalescing concurrent callers.
+
+    All callers for the same URL that arrive while a fetch is running, or
+    within COALESCE_WINDOW_SECONDS after it finished, share its result.
+    The history row is written with the status of the caller that did the fetch.
+
+    Returns a dict with data, error, not_modified, is_duplicate,
+    previous_timestamp, history_id (None if the row could not be written),
+    delta (added / modified / removed items since the previous run) and
+    shared (True when another caller's fetch was reused).
+    """
+    with _flights_lock:
+        flight = _flights.get(url)
+        is_leader = (
+            flight is None
+            or (flight.done.is_set() and time.monotonic() - flight.finished_at > COALESCE_WINDOW_SECONDS)
+        )
+        if is_leader:
+            flight = _Flight()
+            _flights[url] = flight
+
+    if not is_leader:
+        flight.done.wait()
+        print(f"[Extraction] Reusing coalesced fetch for {url}")
+        return dict(flight.result, shared=True)
+
+    try:
+        flight.result = _fetch_and_record(url, status, failure_status)
+    except Exception as e:
+        flight.result = {
+            "data": [],
+            "error": f"Extraction Error: {e}",
+            "not_modified": False,
+            "is_duplicate": False,
+            "previous_timestamp": None,
+            "history_id": None,
+            "delta": item_diff.empty_delta(),
+        }
+    finally:
+        flight.finished_at = time.monotonic()
+        flight.done.set()
+        _prune_flights()
+
+    return dict(flight.result, shared=False)
+
+
+def _prune_flights():
+    cutoff = time.monotonic() - COALESCE_WINDOW_SECONDS
+    with _flights_lock:
+        for url in [u for u, f in _flights.items() if f.done.is_set() and f.finished_at < cutoff]:
+            del _flights[url]
+
+
+def run_manual_extraction(url: str, email: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Manual (/api/extract) flow: shared fetch + history, same-day duplicate
+    rule, optional notification email. Returns the API response body.
+    Raises ExtractionError when the fetch or extraction failed.
+    """
+    # Concurrent requests (and due schedules) for the same URL share one fetch and one history row
+    result = check_url(url, status="success", failure_status="failed")
+    data, error = result['data'], result['error']
+
+    if error:
+        raise ExtractionError(error)
+
+    # Duplicate = same content as the previous extraction, made earlier today
+    is_duplicate = False
+    if result['is_duplicate'] and result['previous_timestamp']:
+        try:
+            try:
+                last_time = datetime.strptime(result['previous_timestamp'], "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                # Try alternate format if default fails
+                last_time = datetime.fromisoformat(result['previous_timestamp'])
+
+            if last_time.date() == datetime.now().date():
+                is_duplicate = True
+                print("Duplicate extraction detected for today.")
+        except Exception as e:
+            print(f"[DB Warning] Duplicate check failed: {e}")
+
+    # Queue the notification email if one is requested; outbox workers deliver it
+    if email:
+        import mailer
+        import outbox
+        try:
+            if is_duplicate:
+                subject = f"[360D] 重複確認通知 - 無更新"
+                body = mailer.build_repeated_body()
+            else:
+                # Only new and changed items since the previous extraction
+                changes = result['delta']['added'] + result['delta']['modified']
+                subject = f"[360D] 擷取結果 - {len(changes)} 筆新增/變更"
+                body = mailer.build_notification_body(changes)
+            # One email per history row and address, even when coalesced requests share the row
+            run_id = result['history_id'] if result['history_id'] is not None else uuid.uuid4().hex
+            outbox.enqueue(f"manual:history:{run_id}:{email}", email, subject, body)
+            print(f"Email to {email} queued")
+        except Exception as mail_e:
+            print(f"[Mailer Error] {mail_e}")
+
+    return {
+        "status": "success",
+        "count": len(data),
+        "data": data,
+        "changes": {name: len(items) for name, items in result['delta'].items()}
+    }
@@ -0,0 +1,141 @@
+import os
+from functools import lru_cache
+from html.parser import HTMLParser
+from typing import Dict, List, Optional, Tuple
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml.etree
+    import lxml.html
+    HAS_LXML = True
+except ImportError:
+    HAS_LXML = False
+
+# "auto" picks lxml when installed, otherwise the stdlib html.parser
+PARSER_BACKEND = os.getenv("HTML_PARSER_BACKEND", "auto")
+
+
+def available_backend(backend: Optional[str] = None) -> str:
+    backend = backend or PARSER_BACKEND
+    if backend == "auto":
+        return "lxml" if HAS_LXML else "html.parser"
+    if backend == "lxml" and not HAS_LXML:
+        print("[HTML] lxml requested but not installed, falling back to html.parser")
+        return "html.parser"
+    return backend
+
+
+@lru_cache(maxsize=32)
+def _container_xpath(containers: Tuple[str, ...]):
+    """Compiled XPath for the outermost elements carrying any of the classes, in document order."""
+    has_class = " or ".join(
+        f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')" for name in containers
+    )
+    return lxml.etree.XPath(f"//*[{has_class}][not(ancestor::*[{has_class}])]")
+
+
+def clear_cache():
+    """Drops the compiled container XPath expressions."""
+    _container_xpath.cache_clear()
+
+
+def _lxml_scoped(html: str, containers: List[str]) -> BeautifulSoup:
+    """
+    Parses the page with lxml's C parser, then hands only the container
+    subtrees to BeautifulSoup, so the large surrounding page is never
+    turned into Python Tag objects.
+    """
+    parser = lxml.html.HTMLParser(encoding="utf-8")
+    try:
+        doc = lxml.html.document_fromstring(html.encode("utf-8"), parser=parser)
+    except Exception:
+        # Empty or unparseable documents
+        return BeautifulSoup("", "html.parser")
+
+    selected = _container_xpath(tuple(containers))(doc)
+    fragment = "".join(lxml.html.tostring(element, encoding="unicode", with_tail=False) for element in selected)
+    return BeautifulSoup(fragment, "html.parser")
+
+
+def parse(html: str, containers: Optional[List[str]] = None, backend: Optional[str] = None) -> BeautifulSoup:
+    """
+    Builds a BeautifulSoup tree for `html`.
+
+    With `containers` (CSS class names) only elements carrying one of those
+    classes, and their subtrees, are materialized; selectors for anything
+    outside those containers will not match.
+    """
+    backend = available_backend(backend)
+    if not containers:
+        return BeautifulSoup(html, backend)
+    if backend == "lxml":
+        return _lxml_scoped(html, containers)
+    return BeautifulSoup(html, backend, parse_only=SoupStrainer(class_=containers))
+
+
+# Elements that never have an end tag
+_VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+    "meta", "param", "source", "track", "wbr",
+}
+
+
+class ContainerWatcher(HTMLParser):
+    """
+    Incremental tag tracker for streaming fetches.
+
+    `groups` maps a container class to the class of the ancestor whose end
+    tag closes that group (None = the container's parent element). Feed raw
+    chunks with feed_bytes(); `done` turns True once every group has been
+    seen and closed, i.e. no more target containers are expected.
+    """
+
+    def __init__(self, groups: Dict[str, Optional[str]]):
+        super().__init__(convert_charrefs=False)
+        self.groups = groups
+        self.done = False
+        self._stack: List[list] = []
+        self._closers: Dict[str, list] = {}
+        self._closed = set()
+
+    def feed_bytes(self, chunk: bytes):
+        # Markup is ASCII in every charset we scrape (UTF-8, Big5), and
+        # latin-1 maps bytes 1:1, so tag and class names survive intact
+        self.feed(chunk.decode("latin-1"))
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        classes = set()
+        for name, value in attrs:
+            if name == "class" and value:
+                classes.update(value.split())
+        entry = [tag, classes]
+        for group, closed_by in self.groups.items():
+            if group not in classes:
+                continue
+            closer = self._stack[-1] if self._stack else None
+            if closed_by:
+                closer = next((e for e in reversed(self._stack) if closed_by in e[1]), closer)
+            self._closers[group] = closer
+            self._closed.discard(group)
+        if tag not in _VOID_ELEMENTS:
+            self._stack.append(entry)
+
+    def handle_endtag(self, tag):
+        if self.done or tag in _VOID_ELEMENTS:
+            return
+        # Pop up to the matching open tag, tolerating unclosed children
+        for index in range(len(self._stack) - 1, -1, -1):
+            if self._stack[index][0] == tag:
+                popped = self._stack[index:]
+                del self._stack[index:]
+                break
+        else:
+            return
+        for group, closer in self._closers.items():
+            if any(closer is entry for entry in popped):
+                self._closed.add(group)
+        if len(self._closed) == len(self.groups):
+            self.done = True
@@ -0,0 +1,129 @@
+import os
+import threading
+from typing import Dict
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Suppress SSL warnings (all scrapers fetch with verify=False)
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+}
+
+# Number of distinct hosts kept in the pool manager, and keep-alive
+# connections held open per host. With POOL_BLOCK the per-host size is also
+# a hard cap on concurrent connections to one origin; a request waits at most
+# POOL_TIMEOUT seconds for a free connection before failing.
+POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "10"))
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "4"))
+POOL_BLOCK = os.getenv("HTTP_POOL_BLOCK", "1") == "1"
+POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "30"))
+
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "new_connections": 0}
+
+
+def _count(key: str):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+# Counted on connect() rather than when the pool creates a connection object:
+# urllib3 silently reconnects a dropped pooled connection on the same object,
+# and that is a fresh TCP/TLS handshake too.
+class _CountingHTTPConnection(HTTPConnection):
+    def connect(self):
+        _count("new_connections")
+        return super().connect()
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        _count("new_connections")
+        return super().connect()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+    def urlopen(self, *args, **kwargs):
+        _count("requests")
+        # requests never passes pool_timeout, which would make a blocked pool wait forever
+        kwargs.setdefault("pool_timeout", POOL_TIMEOUT)
+        return super().urlopen(*args, **kwargs)
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+    def urlopen(self, *args, **kwargs):
+        _count("requests")
+        kwargs.setdefault("pool_timeout", POOL_TIMEOUT)
+        return super().urlopen(*args, **kwargs)
+
+
+class PooledAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report new vs. reused connections."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Returns the shared keep-alive session, creating it on first use.
+    The underlying urllib3 pools are thread-safe, so one session is shared
+    by the scheduler and all API worker threads.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = PooledAdapter(
+                    pool_connections=POOL_CONNECTIONS,
+                    pool_maxsize=POOL_MAXSIZE,
+                    pool_block=POOL_BLOCK,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.headers.update(DEFAULT_HEADERS)
+                _session = session
+    return _session
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    """GET through the shared pool. Defaults match the previous bare requests.get calls."""
+    kwargs.setdefault("verify", False)
+    kwargs.setdefault("timeout", 15)
+    return get_session().get(url, **kwargs)
+
+
+def get_stats() -> Dict[str, int]:
+    """Connection counters: total requests, new connections and reused connections."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["reused_connections"] = max(stats["requests"] - stats["new_connections"], 0)
+    return stats
+
+
+def reset_session():
+    """Closes the shared session and its pooled connections."""
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
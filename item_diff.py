@@ -0,0 +1,54 @@
+import hashlib
+import json
+from typing import Any, Dict, List
+
+
+def item_key(item: Dict[str, Any]) -> str:
+    """Stable identity of a scraped item: link + title + date."""
+    identity = "\x1f".join(str(item.get(field) or "") for field in ("link", "title", "date"))
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+
+def item_fingerprint(item: Dict[str, Any]) -> str:
+    """Digest of every field of an item, used to spot in-place modifications."""
+    canonical = json.dumps(item, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+def diff_items(index: Dict[str, Dict[str, Any]], items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Compares the current items of a page with its stored item index.
+
+    `index` maps item_key -> {'fingerprint': str, 'item': dict} for the previous run.
+    Returns {'added': [...], 'modified': [...], 'removed': [...]} holding items,
+    plus 'upserts' (key -> entry) and 'deletes' (keys) to bring the index up to date.
+    """
+    current = {}
+    for item in items:
+        # Repeated items on one page collapse to one entry
+        current[item_key(item)] = {"fingerprint": item_fingerprint(item), "item": item}
+
+    added, modified, upserts = [], [], {}
+    for key, entry in current.items():
+        previous = index.get(key)
+        if previous is None:
+            added.append(entry["item"])
+            upserts[key] = entry
+        elif previous["fingerprint"] != entry["fingerprint"]:
+            modified.append(entry["item"])
+            upserts[key] = entry
+
+    deletes = [key for key in index if key not in current]
+    removed = [index[key]["item"] for key in deletes]
+
+    return {
+        "added": added,
+        "modified": modified,
+        "removed": removed,
+        "upserts": upserts,
+        "deletes": deletes,
+    }
+
+
+def empty_delta() -> Dict[str, List]:
+    return {"added": [], "modified": [], "removed": []}
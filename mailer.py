@@ -2,112 +2,69 @@ import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
+import threading
+import time
 
 import random
 from datetime import datetime # Added this import
+from functools import lru_cache
+from html import escape
+from string import Template
+from typing import Any, Dict, List, Optional, Tuple
 
+import http_client
+import metrics
 
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_TIMEOUT = int(os.getenv("SMTP_TIMEOUT", "30"))
+# Close the pooled SMTP session after this many seconds without sends
+SMTP_IDLE_SECONDS = int(os.getenv("SMTP_IDLE_SECONDS", "60"))
+
+SEND_SECONDS = metrics.Histogram(
+    "mailer_send_seconds", "Time to hand one email to the webhook or SMTP server", ["transport", "outcome"]
+)
+SMTP_CONNECTIONS = metrics.Counter("mailer_smtp_connections_total", "Authenticated SMTP sessions opened")
 
-def send_notification_email(to_email: str, subject: str, content_html: str = "", updates: list = None):
-    """
-    Sends notification email via n8n Webhook (preferred) or SMTP.
-    """
-    today_str = datetime.now().strftime("%Y-%m-%d")
 
-    # --- Generate HTML Body (Shared for both methods) ---
+# --- Templates ---
+# Parsed once at import. Every scraped value is HTML-escaped before it is
+# substituted; the section/item templates produce trusted markup.
 
-    
-    if updates and len(updates) > 0:
-        # Template A: Update Found
-        body = f"""
+# Template A: Update Found
+UPDATE_TEMPLATE = Template("""
         <html>
         <body>
-            <h2>今日更新了 ({today_str})</h2>
+            <h2>今日更新了 ($today)</h2>
             <p>親愛的用戶您好：</p>
             <p>系統檢測到目標網站有新的內容更新。</p>
             <hr>
             <h3>即時更新詳情：</h3>
             <ul>
-                {"".join([f"<li><a href='{item.get('link', '#')}'>{item.get('title', 'No Title')}</a> <span style='color:#888'>({item.get('date', '')})</span></li>" for item in updates])}
+                $items
             </ul>
         </body>
         </html>
-        """
-    else:
-        # Template B: No Update
-        body = f"""
+        """)
+
+# Template B: No Update
+NO_UPDATE_TEMPLATE = Template("""
         <html>
         <body>
-            <h2>今日沒有更新 ({today_str})</h2>
+            <h2>今日沒有更新 ($today)</h2>
             <p>親愛的用戶您好：</p>
             <p>今日目標網站目前沒有檢測到顯著的變動。</p>
             <hr>
             <p>系統將持續為您監控...</p>
         </body>
         </html>
-        """
-    
-    # 1. Try Webhook
-    webhook_url = os.getenv("MAILER_WEBHOOK_URL")
-    if webhook_url:
-        try:
-            import requests
-            print(f"[Mailer] Sending via Webhook: {webhook_url}")
-            # Send PRE-GENERATED HTML
-            payload = {
-                "to_email": to_email,
-                "subject": subject,
-                "html_body": body # Key changed to be explicit
-            }
-            resp = requests.post(webhook_url, json=payload, timeout=10)
-            if resp.status_code == 200:
-                print("[Mailer] Webhook success.")
-                return True
-            else:
-                print(f"[Mailer] Webhook failed: {resp.status_code} {resp.text}")
-        except Exception as e:
-            print(f"[Mailer] Webhook error: {e}")
-
-    # 2. Try SMTP 
-    smtp_email = os.getenv("SMTP_EMAIL")
-    smtp_password = os.getenv("SMTP_PASSWORD")
-    
-    if not smtp_email or not smtp_password:
-        if not webhook_url:
-            print("[Mailer] No Webhook or SMTP Credentials found. Simulating email.")
-            print(f"--- Email to {to_email} ---\nSubject: {subject}\n-----------------------")
-        return True 
+        """)
 
-    msg = MIMEMultipart()
-    msg['From'] = f"360d Notification <{smtp_email}>"
-    msg['To'] = to_email
-    msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'html')) # Use the pre-generated body
-
-    try:
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(smtp_email, smtp_password)
-        server.send_message(msg)
-        server.quit()
-        print(f"[Mailer] Email sent to {to_email}")
-        return True
-    except Exception as e:
-        print(f"[Mailer] Failed to send email: {e}")
-        return False
-
-def send_repeated_notification_email(to_email: str, subject: str):
-    """
-    Sends a 'Repeated Check - No Update' email.
-    """
-    today_str = datetime.now().strftime("%Y-%m-%d")
-
-    
-    # Template C: No New Updates (Repeated Check)
-    body = f"""
+# Template C: No New Updates (Repeated Check)
+REPEATED_TEMPLATE = Template("""
     <html>
     <body>
-        <h2>重複確認通知 ({today_str})</h2>
+        <h2>重複確認通知 ($today)</h2>
         <p>親愛的用戶您好：</p>
         <p>您剛剛再次執行了爬取，但系統比對後發現，網站內容與您上次執行時完全相同。</p>
         <p>這代表目前沒有新的更新。</p>
@@ -115,47 +72,297 @@ def send_repeated_notification_email(to_email: str, subject: str):
         <p>祝您有美好的一天！</p>
     </body>
     </html>
+    """)
+
+# Template D: Digest of several monitored pages
+DIGEST_TEMPLATE = Template("""
+    <html>
+    <body>
+        <h2>今日監控摘要 ($today)</h2>
+        <p>親愛的用戶您好：</p>
+        <p>以下是您監控的 $count 個網站的最新檢查結果。</p>
+        <hr>
+        $sections
+        <hr>
+        <p>系統將持續為您監控...</p>
+    </body>
+    </html>
+    """)
+
+DIGEST_SECTION_TEMPLATE = Template("""
+            <h3><a href='$url'>$url</a></h3>
+            <p style='color:#888'>$subject</p>
+            $details
+        """)
+
+ITEM_TEMPLATE = Template("<li><a href='$link'>$title</a> <span style='color:#888'>($date)</span></li>")
+
+# Rendered bodies are cached by (date, items), so one payload sent to many
+# recipients is rendered once
+TEMPLATE_CACHE_SIZE = int(os.getenv("MAILER_TEMPLATE_CACHE_SIZE", "256"))
+
+
+def _item_key(updates) -> Tuple[Tuple[str, str, str], ...]:
+    """Hashable form of an update list: only the fields the templates use."""
+    return tuple(
+        (str(item.get('link', '#')), str(item.get('title', 'No Title')), str(item.get('date', '')))
+        for item in updates or ()
+    )
+
+
+def _render_items(items: Tuple[Tuple[str, str, str], ...]) -> str:
+    return "".join(
+        ITEM_TEMPLATE.substitute(link=escape(link), title=escape(title), date=escape(date))
+        for link, title, date in items
+    )
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _render_notification(today: str, items: Tuple[Tuple[str, str, str], ...]) -> str:
+    if items:
+        return UPDATE_TEMPLATE.substitute(today=today, items=_render_items(items))
+    return NO_UPDATE_TEMPLATE.substitute(today=today)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _render_repeated(today: str) -> str:
+    return REPEATED_TEMPLATE.substitute(today=today)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def _render_digest(today: str, sections: Tuple[Tuple[str, str, Tuple[Tuple[str, str, str], ...]], ...]) -> str:
+    parts = []
+    for url, subject, items in sections:
+        if items:
+            details = f"<ul>{_render_items(items)}</ul>"
+        else:
+            details = "<p>目前沒有檢測到顯著的變動。</p>"
+        parts.append(DIGEST_SECTION_TEMPLATE.substitute(url=escape(url), subject=escape(subject), details=details))
+    return DIGEST_TEMPLATE.substitute(today=today, count=len(sections), sections="".join(parts))
+
+
+def _today() -> str:
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def build_notification_body(updates: list = None) -> str:
+    """Renders the HTML body for an update / no-update notification."""
+    return _render_notification(_today(), _item_key(updates))
+
+
+def build_repeated_body() -> str:
+    """Renders the HTML body for a 'Repeated Check - No Update' email."""
+    return _render_repeated(_today())
+
+
+def build_digest_body(sections: List[Dict[str, Any]]) -> str:
+    """
+    Renders one email covering several scheduled results for the same
+    recipient. Each section is {'url', 'subject', 'updates'}.
     """
+    key = tuple(
+        (str(section['url']), str(section['subject']), _item_key(section.get('updates')))
+        for section in sections
+    )
+    return _render_digest(_today(), key)
 
-    # 1. Try n8n Webhook
-    webhook_url = os.getenv("MAILER_WEBHOOK_URL")
-    if webhook_url:
+
+class SMTPPool:
+    """
+    One authenticated SMTP session shared by every sender.
+
+    STARTTLS and AUTH happen once per connection instead of once per email.
+    A connection idle for more than NOOP_AFTER_SECONDS is probed with NOOP
+    before reuse, a dropped connection is reopened and the message retried
+    once, and the session is closed after IDLE_SECONDS without sends.
+    """
+
+    NOOP_AFTER_SECONDS = 5
+
+    def __init__(self, host: str, port: int, timeout: int, idle_seconds: int):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._server = None
+        self._credentials = None
+        self._last_used = 0.0
+        self._idle_timer = None
+
+    def _connect(self, credentials):
+        self._disconnect()
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        try:
+            server.starttls()
+            server.login(*credentials)
+        except Exception:
+            server.close()
+            raise
+        SMTP_CONNECTIONS.inc()
+        self._server = server
+        self._last_used = time.monotonic()
+        self._credentials = credentials
+        print(f"[Mailer] Opened SMTP session to {self.host}:{self.port}")
+
+    def _disconnect(self):
+        if self._server is None:
+            return
         try:
-            import requests
-            print(f"[Mailer] Sending 'Repeated' email via Webhook: {webhook_url}")
-            payload = {
-                "to_email": to_email,
-                "subject": subject,
-                "html_body": body
-            }
-            resp = requests.post(webhook_url, json=payload, timeout=10)
-            if resp.status_code == 200:
-                print("[Mailer] Webhook success.")
-                return True
-        except Exception as e:
-            print(f"[Mailer] Webhook error: {e}")
+            self._server.quit()
+        except Exception:
+            self._server.close()
+        self._server = None
+
+    def _ensure(self, credentials):
+        if self._server is None or self._credentials != credentials:
+            self._connect(credentials)
+            return
+        if time.monotonic() - self._last_used > self.NOOP_AFTER_SECONDS:
+            try:
+                status = self._server.noop()[0]
+            except OSError:
+                # Includes smtplib.SMTPException
+                status = None
+            if status != 250:
+                print("[Mailer] SMTP session went stale, reconnecting.")
+                self._connect(credentials)
+
+    def _send_one(self, credentials, msg) -> Optional[str]:
+        start = time.perf_counter()
+        error = self._attempt(credentials, msg)
+        SEND_SECONDS.observe(time.perf_counter() - start, transport="smtp", outcome="error" if error else "ok")
+        return error
+
+    def _attempt(self, credentials, msg) -> Optional[str]:
+        error = None
+        for attempt in (1, 2):
+            try:
+                self._ensure(credentials)
+                refused = self._server.send_message(msg)
+                self._last_used = time.monotonic()
+                if refused:
+                    print(f"[Mailer] Recipients refused: {list(refused)}")
+                return None
+            except smtplib.SMTPServerDisconnected as e:
+                error = f"SMTP connection error: {e}"
+            except smtplib.SMTPException as e:
+                # Rejected by the server (SMTPException subclasses OSError, so check it first)
+                error = f"SMTP error: {e}"
+                break
+            except OSError as e:
+                error = f"SMTP connection error: {e}"
+            # Connection-level failure: drop the session and retry once on a fresh one
+            if self._server is not None:
+                self._server.close()
+                self._server = None
+        print(f"[Mailer] Failed to send email to {msg['To']}: {error}")
+        return error
+
+    def send(self, credentials, messages: List[MIMEMultipart]) -> List[Optional[str]]:
+        """Sends the messages over one session, in order; returns each message's error (None when sent)."""
+        with self._lock:
+            if self._idle_timer:
+                self._idle_timer.cancel()
+            errors = [self._send_one(credentials, msg) for msg in messages]
+            self._idle_timer = threading.Timer(self.idle_seconds, self._close_if_idle)
+            self._idle_timer.daemon = True
+            self._idle_timer.start()
+        return errors
+
+    def _close_if_idle(self):
+        with self._lock:
+            if self._server is not None and time.monotonic() - self._last_used >= self.idle_seconds:
+                self._disconnect()
+                print("[Mailer] Closed idle SMTP session.")
+
+    def close(self):
+        with self._lock:
+            if self._idle_timer:
+                self._idle_timer.cancel()
+            self._disconnect()
+
+
+_smtp_pool = SMTPPool(SMTP_HOST, SMTP_PORT, SMTP_TIMEOUT, SMTP_IDLE_SECONDS)
+
+
+def close_smtp():
+    """Closes the pooled SMTP session (it reopens on the next send)."""
+    _smtp_pool.close()
+
+
+def _send_webhook(webhook_url: str, to_email: str, subject: str, body: str) -> Optional[str]:
+    start = time.perf_counter()
+    error = _post_webhook(webhook_url, to_email, subject, body)
+    SEND_SECONDS.observe(time.perf_counter() - start, transport="webhook", outcome="error" if error else "ok")
+    return error
+
+
+def _post_webhook(webhook_url: str, to_email: str, subject: str, body: str) -> Optional[str]:
+    try:
+        print(f"[Mailer] Sending via Webhook: {webhook_url}")
+        # Send PRE-GENERATED HTML
+        payload = {
+            "to_email": to_email,
+            "subject": subject,
+            "html_body": body # Key changed to be explicit
+        }
+        resp = http_client.get_session().post(webhook_url, json=payload, timeout=10)
+        if resp.status_code == 200:
+            print("[Mailer] Webhook success.")
+            return None
+        print(f"[Mailer] Webhook failed: {resp.status_code} {resp.text}")
+        return f"Webhook HTTP {resp.status_code}"
+    except Exception as e:
+        print(f"[Mailer] Webhook error: {e}")
+        return f"Webhook error: {e}"
+
+
+def deliver(messages: List[Dict[str, str]]) -> List[Optional[str]]:
+    """
+    Delivers pre-rendered {'to_email', 'subject', 'body'} messages via n8n
+    Webhook (preferred) or the pooled SMTP session. Returns each message's
+    error, None when it was delivered.
+    """
+    errors: List[Optional[str]] = [None] * len(messages)
+    pending = []
+
+    # 1. Try Webhook
+    webhook_url = os.getenv("MAILER_WEBHOOK_URL")
+    for index, message in enumerate(messages):
+        if not webhook_url:
+            pending.append(index)
+            continue
+        errors[index] = _send_webhook(webhook_url, message['to_email'], message['subject'], message['body'])
+        if errors[index]:
+            pending.append(index)
+    if not pending:
+        return errors
 
     # 2. Try SMTP
     smtp_email = os.getenv("SMTP_EMAIL")
     smtp_password = os.getenv("SMTP_PASSWORD")
-    
+
     if not smtp_email or not smtp_password:
-        return True
+        if not webhook_url:
+            for index in pending:
+                print("[Mailer] No Webhook or SMTP Credentials found. Simulating email.")
+                print(f"--- Email to {messages[index]['to_email']} ---\nSubject: {messages[index]['subject']}\n-----------------------")
+        # Otherwise the webhook error stands: there is no fallback transport
+        return errors
 
-    msg = MIMEMultipart()
-    msg['From'] = f"360d Notification <{smtp_email}>"
-    msg['To'] = to_email
-    msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'html'))
+    mime_messages = []
+    for index in pending:
+        msg = MIMEMultipart()
+        msg['From'] = f"360d Notification <{smtp_email}>"
+        msg['To'] = messages[index]['to_email']
+        msg['Subject'] = messages[index]['subject']
+        msg.attach(MIMEText(messages[index]['body'], 'html'))
+        mime_messages.append(msg)
 
-    try:
-        server = smtplib.SMTP('smtp.gmail.com', 587)
-        server.starttls()
-        server.login(smtp_email, smtp_password)
-        server.send_message(msg)
-        server.quit()
-        print(f"[Mailer] Repeated-Check Email sent to {to_email}")
-        return True
-    except Exception as e:
-        print(f"[Mailer] Failed to send email: {e}")
-        return False
+    smtp_errors = _smtp_pool.send((smtp_email, smtp_password), mime_messages)
+    for index, error in zip(pending, smtp_errors):
+        errors[index] = error
+        if error is None:
+            print(f"[Mailer] Email sent to {messages[index]['to_email']}")
+    return errors
@@ -0,0 +1,183 @@
+"""
+Durable outbound notification queue.
+
+Callers render an email and enqueue() it under an idempotency key; worker
+threads drain the SQLite outbound_queue table through mailer.deliver, so a
+slow webhook or SMTP server never stalls scraping or API responses. Failed
+messages are retried with exponential backoff and dead-lettered after
+MAX_ATTEMPTS; the same idempotency key is never queued twice.
+
+Keys used: "schedule:{schedule_id}:history:{history_id}" for scheduled
+runs and "manual:history:{history_id}:{email}" for /api/extract.
+
+Scheduled results go through queue_update(): with DIGEST_WINDOW_SECONDS > 0
+they are held per recipient and, once the oldest has waited that long,
+merged into a single digest email ("digest:{email}:{first_id}-{last_id}").
+"""
+import os
+import random
+import threading
+from typing import Dict, List, Optional
+
+import database
+import mailer
+import metrics
+
+WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "20"))
+MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "6"))
+# Retry n waits BACKOFF_BASE_SECONDS * 2^(n-1), capped, plus up to 10% jitter
+BACKOFF_BASE_SECONDS = float(os.getenv("OUTBOX_BACKOFF_BASE_SECONDS", "30"))
+BACKOFF_MAX_SECONDS = float(os.getenv("OUTBOX_BACKOFF_MAX_SECONDS", "3600"))
+# Idle workers poll this often for retries that became due; enqueue() wakes them immediately
+POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", "5"))
+# Scheduled results for one address arriving within this window share one email (0 disables digests)
+DIGEST_WINDOW_SECONDS = int(os.getenv("DIGEST_WINDOW_SECONDS", "60"))
+
+MESSAGES_TOTAL = metrics.Counter("outbox_messages_total", "Outbound messages by delivery result", ["result"])
+DIGEST_PARTS_TOTAL = metrics.Counter("outbox_digest_parts_total", "Scheduled results merged into digest emails")
+BATCH_SECONDS = metrics.Histogram("outbox_batch_seconds", "Time to deliver one claimed batch")
+
+_wake = threading.Event()
+_stop = threading.Event()
+_workers: List[threading.Thread] = []
+_workers_lock = threading.Lock()
+# Only one thread assembles digests at a time
+_digest_lock = threading.Lock()
+
+
+def enqueue(idempotency_key: str, to_email: str, subject: str, body: str) -> Optional[int]:
+    """Queues a rendered email. Returns its id, or None if the key was already queued."""
+    message_id = database.enqueue_outbound(idempotency_key, to_email, subject, body)
+    if message_id is None:
+        print(f"[Outbox] Skipping duplicate message {idempotency_key}")
+        MESSAGES_TOTAL.inc(result="duplicate")
+    else:
+        MESSAGES_TOTAL.inc(result="queued")
+        _wake.set()
+    return message_id
+
+
+def queue_update(idempotency_key: str, to_email: str, url: str, subject: str, updates: List[Dict]) -> Optional[int]:
+    """
+    Queues a scheduled result for `to_email`: into the recipient's pending
+    digest, or as its own email when digests are disabled.
+    """
+    if DIGEST_WINDOW_SECONDS <= 0:
+        return enqueue(idempotency_key, to_email, subject, mailer.build_notification_body(updates))
+    item_id = database.add_digest_item(idempotency_key, to_email, url, subject, updates)
+    if item_id is None:
+        print(f"[Outbox] Skipping duplicate digest item {idempotency_key}")
+    return item_id
+
+
+def flush_digests(force: bool = False) -> int:
+    """
+    Turns every recipient's pending items into one queued email once the
+    oldest item is DIGEST_WINDOW_SECONDS old (immediately with force=True).
+    Returns the number of emails queued.
+    """
+    with _digest_lock:
+        recipients = database.get_due_digest_recipients(0 if force else DIGEST_WINDOW_SECONDS)
+        for to_email in recipients:
+            items = database.get_pending_digest_items(to_email)
+            if not items:
+                continue
+            if len(items) == 1:
+                # A lone result keeps its usual subject and layout
+                subject = items[0]['subject']
+                body = mailer.build_notification_body(items[0]['updates'])
+            else:
+                total = sum(len(item['updates']) for item in items)
+                subject = f"360d 通知: {len(items)} 個網站的今日監控摘要 ({total} 則更新)"
+                body = mailer.build_digest_body(items)
+            key = f"digest:{to_email}:{items[0]['id']}-{items[-1]['id']}"
+            database.flush_digest([item['id'] for item in items], key, to_email, subject, body)
+            DIGEST_PARTS_TOTAL.inc(len(items))
+            MESSAGES_TOTAL.inc(result="queued")
+            print(f"[Outbox] Queued digest of {len(items)} result(s) for {to_email}")
+    if recipients:
+        _wake.set()
+    return len(recipients)
+
+
+def backoff_seconds(attempts: int) -> float:
+    delay = min(BACKOFF_BASE_SECONDS * (2 ** (attempts - 1)), BACKOFF_MAX_SECONDS)
+    return delay + random.uniform(0, delay * 0.1)
+
+
+def process_once() -> int:
+    """Claims and delivers one batch of due messages. Returns how many were claimed."""
+    messages = database.claim_outbound(BATCH_SIZE)
+    if not messages:
+        return 0
+
+    with BATCH_SECONDS.time():
+        try:
+            errors = mailer.deliver(messages)
+        except Exception as e:
+            errors = [f"Delivery crashed: {e}"] * len(messages)
+
+    for message, error in zip(messages, errors):
+        if error is None:
+            database.mark_outbound_sent(message['id'])
+            MESSAGES_TOTAL.inc(result="sent")
+        elif message['attempts'] >= MAX_ATTEMPTS:
+            database.mark_outbound_failed(message['id'], error)
+            MESSAGES_TOTAL.inc(result="dead")
+            print(f"[Outbox] Dead-lettered message {message['id']} to {message['to_email']} "
+                  f"after {message['attempts']} attempts: {error}")
+        else:
+            delay = backoff_seconds(message['attempts'])
+            database.mark_outbound_failed(message['id'], error, retry_in_seconds=delay)
+            MESSAGES_TOTAL.inc(result="retry")
+            print(f"[Outbox] Message {message['id']} failed (attempt {message['attempts']}), retrying in {delay:.0f}s: {error}")
+    return len(messages)
+
+
+def drain():
+    """
+    Delivers everything that is due now, pending digests included, on the
+    calling thread (for scripts without workers).
+    """
+    flush_digests(force=True)
+    while process_once():
+        pass
+
+
+def _worker_loop():
+    while not _stop.is_set():
+        try:
+            flush_digests()
+            if process_once():
+                continue
+        except Exception as e:
+            print(f"[Outbox] Worker error: {e}")
+        _wake.wait(POLL_SECONDS)
+        _wake.clear()
+
+
+def start():
+    """Starts the delivery workers (idempotent). Messages left mid-delivery by a crash are retried."""
+    with _workers_lock:
+        if _workers:
+            return
+        requeued = database.requeue_stale_outbound()
+        if requeued:
+            print(f"[Outbox] Re-queued {requeued} message(s) interrupted mid-delivery.")
+        _stop.clear()
+        for index in range(WORKERS):
+            worker = threading.Thread(target=_worker_loop, name=f"outbox-{index}", daemon=True)
+            worker.start()
+            _workers.append(worker)
+    print(f"[Outbox] Started {WORKERS} delivery worker(s).")
+
+
+def stop(timeout: float = 5):
+    """Stops the delivery workers, letting each finish the message it is sending (up to `timeout` seconds)."""
+    with _workers_lock:
+        _stop.set()
+        _wake.set()
+        for worker in _workers:
+            worker.join(timeout)
+        _workers.clear()
@@ -0,0 +1,125 @@
+"""
+History retention, compaction and daily rollup.
+
+Each run:
+  1. rolls every complete day up into history_daily (runs, failures,
+     changes, changed items per URL), before anything is pruned
+  2. drops history rows that are unchanged repeats of the previous row for
+     their URL, older than REPEAT_DAYS and outside the newest KEEP_LAST rows
+     of that URL; rows that changed the content are always kept
+  3. with each slice of dropped rows, removes the payloads only those rows
+     referenced (and their search index entries)
+  4. removes delivered notifications older than NOTIFICATION_DAYS
+  5. returns free pages to the filesystem with incremental vacuum
+
+Deletes and vacuum run in small slices with short pauses and stop at
+TIME_BUDGET_SECONDS, so API requests never wait long on the write lock; the
+next run picks up where this one stopped. The scheduler runs this every
+INTERVAL_MINUTES; `python retention.py` runs it once.
+
+Databases created before incremental auto-vacuum need a one-time full VACUUM
+to convert, which blocks writers while the file is rewritten. The scheduled
+job never does it; run `python retention.py --convert-auto-vacuum` during a
+quiet period.
+"""
+import argparse
+import os
+import time
+
+import database
+import metrics
+
+KEEP_LAST = int(os.getenv("RETENTION_KEEP_LAST", "20"))
+# At least one day, so rows are always rolled up before they can be pruned
+REPEAT_DAYS = max(1, int(os.getenv("RETENTION_REPEAT_DAYS", "7")))
+NOTIFICATION_DAYS = int(os.getenv("RETENTION_NOTIFICATION_DAYS", "30"))
+BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "500"))
+VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "256"))
+TIME_BUDGET_SECONDS = float(os.getenv("RETENTION_TIME_BUDGET_SECONDS", "30"))
+INTERVAL_MINUTES = int(os.getenv("RETENTION_INTERVAL_MINUTES", "60"))
+# Pause between slices, leaving the write lock free for other threads
+SLICE_PAUSE_SECONDS = 0.05
+
+ROWS_REMOVED = metrics.Counter("retention_rows_removed_total", "Rows removed by retention", ["table"])
+# Where the walk for prunable history stopped; None starts a new pass from the oldest row
+_prune_cursor = None
+
+RUN_SECONDS = metrics.Histogram("retention_run_seconds", "Duration of a retention run",
+                                buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120))
+
+
+def _sliced(step, deadline: float) -> int:
+    """Calls step() until it returns 0 or the deadline passes; returns the total."""
+    total = 0
+    while time.monotonic() < deadline:
+        done = step()
+        if not done:
+            break
+        total += done
+        time.sleep(SLICE_PAUSE_SECONDS)
+    return total
+
+
+def _prune_history(deadline: float):
+    """
+    Continues the walk over old history rows, deleting unchanged repeats, until
+    the pass completes or the deadline passes. Returns (history rows, payloads)
+    removed. Each slice resumes after the last row examined, so a pass costs
+    one walk of the old rows however many runs it is spread over.
+    """
+    global _prune_cursor
+    removed, payloads = 0, 0
+    while time.monotonic() < deadline:
+        ids, _prune_cursor = database.find_prunable_history(
+            KEEP_LAST, REPEAT_DAYS, after=_prune_cursor, limit=BATCH_SIZE
+        )
+        if ids:
+            rows, orphans = database.delete_history_rows(ids)
+            removed += rows
+            payloads += orphans
+        if _prune_cursor is None:
+            break
+        time.sleep(SLICE_PAUSE_SECONDS)
+    return removed, payloads
+
+
+def run() -> dict:
+    start = time.monotonic()
+    deadline = start + TIME_BUDGET_SECONDS
+    stats = {"rolled_up": 0, "history": 0, "payloads": 0, "notifications": 0, "free_pages": 0}
+    try:
+        stats["rolled_up"] = database.rollup_history_daily()
+        stats["history"], stats["payloads"] = _prune_history(deadline)
+        stats["notifications"] = database.purge_delivered_notifications(NOTIFICATION_DAYS)
+
+        def vacuum_slice():
+            stats["free_pages"] = database.incremental_vacuum(VACUUM_PAGES)
+            return stats["free_pages"]
+
+        _sliced(vacuum_slice, deadline)
+    except Exception as e:
+        print(f"[Retention] Run failed: {e}")
+    finally:
+        RUN_SECONDS.observe(time.monotonic() - start)
+
+    for table in ("history", "payloads", "notifications"):
+        if stats[table]:
+            ROWS_REMOVED.inc(stats[table], table=table)
+    print(f"[Retention] Rolled up {stats['rolled_up']} daily (day, URL) row(s); removed {stats['history']} history row(s), "
+          f"{stats['payloads']} payload(s), {stats['notifications']} sent email(s); "
+          f"{stats['free_pages']} free page(s) left ({time.monotonic() - start:.1f}s)")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run history retention once.")
+    parser.add_argument("--convert-auto-vacuum", action="store_true",
+                        help="first switch an older database to incremental auto-vacuum (full VACUUM, blocks writers)")
+    args = parser.parse_args()
+    database.init_db()
+    if args.convert_auto_vacuum:
+        if database.enable_incremental_vacuum():
+            print("[Retention] Converted the database to incremental auto-vacuum.")
+        else:
+            print("[Retention] Database already uses incremental auto-vacuum.")
+    run()
@@ -0,0 +1,88 @@
+import heapq
+import threading
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional, Tuple
+
+DB_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_db_time(value: str) -> datetime:
+    """Parses a SQLite datetime('now') string (naive UTC)."""
+    try:
+        return datetime.strptime(value, DB_TIME_FORMAT)
+    except ValueError:
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+
+
+def utc_now() -> datetime:
+    """Current time as naive UTC, comparable with parse_db_time values."""
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class ScheduleQueue:
+    """
+    Thread-safe min-heap of (next_run, schedule_id) for active schedules.
+    Updates and removals are lazy: stale heap entries are skipped when they
+    reach the top, so every operation stays O(log n).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap: List[Tuple[datetime, int]] = []
+        self._entries = {}
+
+    def load(self, schedules: Iterable[dict]):
+        """Replaces the queue contents with rows from the schedules table."""
+        with self._lock:
+            self._entries = {}
+            for row in schedules:
+                if row.get('next_run'):
+                    self._entries[row['id']] = parse_db_time(row['next_run'])
+            self._heap = [(next_run, schedule_id) for schedule_id, next_run in self._entries.items()]
+            heapq.heapify(self._heap)
+
+    def upsert(self, schedule_id: int, next_run):
+        if isinstance(next_run, str):
+            next_run = parse_db_time(next_run)
+        with self._lock:
+            self._entries[schedule_id] = next_run
+            heapq.heappush(self._heap, (next_run, schedule_id))
+
+    def remove(self, schedule_id: int):
+        with self._lock:
+            self._entries.pop(schedule_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._heap = []
+
+    def _drop_stale(self):
+        while self._heap:
+            next_run, schedule_id = self._heap[0]
+            if self._entries.get(schedule_id) == next_run:
+                return
+            heapq.heappop(self._heap)
+
+    def next_due(self) -> Optional[datetime]:
+        """Earliest next_run in the queue (naive UTC), or None when empty."""
+        with self._lock:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: Optional[datetime] = None) -> List[int]:
+        """Removes and returns the ids of all schedules due at `now`."""
+        now = now or utc_now()
+        due = []
+        with self._lock:
+            self._drop_stale()
+            while self._heap and self._heap[0][0] <= now:
+                _, schedule_id = heapq.heappop(self._heap)
+                del self._entries[schedule_id]
+                due.append(schedule_id)
+                self._drop_stale()
+        return due
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -1,86 +1,251 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.interval import IntervalTrigger
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlparse
+import threading
 import time
 import os
+import uuid
 import database
-import mailer
+import metrics
+import outbox
+from schedule_queue import ScheduleQueue, parse_db_time, utc_now
 from typing import List
 
 # Single scheduler instance
 scheduler = BackgroundScheduler()
 
-def check_and_run_jobs():
+# Worker pool for due jobs: global concurrency cap plus a per-host cap
+MAX_WORKERS = int(os.getenv("SCHEDULER_MAX_WORKERS", "8"))
+MAX_JOBS_PER_HOST = int(os.getenv("SCHEDULER_MAX_JOBS_PER_HOST", "2"))
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="scheduler-job")
+
+# Schedules currently executing, running URL task count per host, and
+# due schedules held back by the per-host cap
+_state_lock = threading.Lock()
+_in_flight = set()
+_host_active = {}
+_deferred = set()
+
+# In-memory wakeup queue keyed on next_run; the database stays the source of truth
+_queue = ScheduleQueue()
+# Full reload from the database, catching edits made outside the API (e.g. stop_all_schedules.py)
+RESYNC_MINUTES = int(os.getenv("SCHEDULER_RESYNC_MINUTES", "10"))
+
+CHECK_SECONDS = metrics.Histogram("scheduler_check_seconds", "Time to find and dispatch due schedules")
+URL_RUN_SECONDS = metrics.Histogram("scheduler_url_run_seconds", "Time to scrape, notify and reschedule one URL", ["outcome"])
+LAG_SECONDS = metrics.Histogram(
+    "scheduler_dispatch_lag_seconds", "Delay between a schedule's next_run and its dispatch",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600),
+)
+DEFERRED_TOTAL = metrics.Counter("scheduler_deferred_total", "Due schedules held back by the per-host limit")
+metrics.Gauge("scheduler_in_flight", "Schedules currently executing", function=lambda: len(_in_flight))
+metrics.Gauge("scheduler_deferred", "Due schedules waiting for a host slot", function=lambda: len(_deferred))
+metrics.Gauge("scheduler_queue_size", "Schedules in the wakeup queue", function=lambda: len(_queue))
+
+def _host_of(url: str) -> str:
+    return urlparse(url).netloc.lower()
+
+def _notification_for(job: dict, result: dict):
+    """The email for one subscriber of a finished scrape, or None when the scrape failed."""
+    if result['error']:
+        return None
+    # Only new and changed items are reported
+    changes = result['delta']['added'] + result['delta']['modified']
+    # Send Email based on duplicate check
+    if result['is_duplicate']:
+        # No change - send "no update" email
+        subject = "360d 通知: 今日無更新 (內容未變更)"
+        updates = []
+    elif len(changes) > 0:
+        subject = f"360d 通知: 今日有更新 ({len(changes)} 則)"
+        updates = changes
+    else:
+        subject = "360d 通知: 今日無更新"
+        updates = []
+    # One email per schedule and history row, however often this run is retried
+    run_id = result['history_id'] if result['history_id'] is not None else uuid.uuid4().hex
+    return {
+        "key": f"schedule:{job['id']}:history:{run_id}",
+        "to_email": job['email'],
+        "subject": subject,
+        "updates": updates,
+    }
+
+def _reschedule(job: dict):
+    try:
+        # Handle one-time vs continuous scheduling
+        is_continuous = job.get('is_continuous', 1)  # Default to continuous
+        if is_continuous:
+            # Update Next Run for continuous scheduling
+            job_unit = job.get('unit', 'days')
+            next_run = database.update_schedule_next_run(job['id'], job['frequency_days'], unit=job_unit)
+            if next_run:
+                _queue.upsert(job['id'], next_run)
+        else:
+            # One-time scheduling - deactivate after running
+            database.toggle_schedule_active(job['id'], False)
+            _queue.remove(job['id'])
+            print(f"[Scheduler] One-time job {job['id']} completed and deactivated.")
+        
+    except Exception as e:
+        print(f"Error processing job {job['id']}: {e}")
+
+@metrics.timed(URL_RUN_SECONDS)
+def run_url_jobs(url: str, jobs: List[dict]):
+    """
+    Runs every due schedule for one URL: a single scrape, dedupe and history
+    row (shared via extraction.check_url), then queue each subscriber's
+    notification in the outbox and reschedule it.
     """
-    Checks for due schedules in DB, runs scraper, sends email.
+    import extraction
+    
+    # Scrape once (Forced CSS)
+    print(f"Running {len(jobs)} job(s) for {url} (Auto-CSS)")
+    result = extraction.check_url(url, status="scheduled_success")
+    if result['error']:
+        print(f"Job failed: {result['error']}")
+    
+    # Delivery happens in the outbox workers, so slow mail never holds up the sweep
+    for job in jobs:
+        message = _notification_for(job, result)
+        if message is None:
+            continue
+        try:
+            # Merged with the recipient's other results due in the same window
+            outbox.queue_update(message['key'], message['to_email'], url, message['subject'], message['updates'])
+        except Exception as e:
+            print(f"Error queueing notification for job {job['id']}: {e}")
+
+    for job in jobs:
+        _reschedule(job)
+
+def _finish_jobs(jobs: List[dict], host: str):
+    with _state_lock:
+        for job in jobs:
+            _in_flight.discard(job['id'])
+        _host_active[host] -= 1
+        if _host_active[host] <= 0:
+            del _host_active[host]
+        # A host slot freed up: make deferred schedules due again
+        retry = list(_deferred)
+        _deferred.clear()
+    now = utc_now()
+    for schedule_id in retry:
+        _queue.upsert(schedule_id, now)
+    _arm()
+
+def _run_tracked(url: str, jobs: List[dict], host: str):
+    try:
+        run_url_jobs(url, jobs)
+    finally:
+        _finish_jobs(jobs, host)
+
+@metrics.timed(CHECK_SECONDS)
+def check_and_run_jobs(wait: bool = False):
+    """
+    Checks for due schedules in DB and dispatches them to the worker pool,
+    one task per URL. A schedule that is still running is never dispatched
+    again, and URLs over the per-host cap are left due for the next check.
+    Pass wait=True to block until the dispatched jobs have finished.
     """
     due_jobs = database.get_due_schedules()
     print(f"[{datetime.now()}] Checking jobs... Found {len(due_jobs)} due.")
 
-    import scraper_css
-    import json
-    
+    # Group by URL so all subscribers of one page share a single fetch
+    by_url = {}
     for job in due_jobs:
-        try:
-            # 1. Scrape (Forced CSS)
-            print(f"Running job for {job['url']} (Auto-CSS)")
-            data, error = scraper_css.fetch_data(job['url'])
-            
-            if error:
-                status = "failed"
-                print(f"Job failed: {error}")
-            else:
-                status = "success"
-                
-                # 2. Check for duplicate content
-                is_duplicate = False
-                last_history = database.get_last_history_for_url(job['url'])
-                
-                if last_history:
-                    try:
-                        current_json = json.dumps(data, sort_keys=True, ensure_ascii=False)
-                        last_json = json.dumps(json.loads(last_history['data_json']), sort_keys=True, ensure_ascii=False)
-                        
-                        if current_json == last_json:
-                            is_duplicate = True
-                            print(f"[Scheduler] Duplicate content detected for {job['url']}")
-                    except Exception as e:
-                        print(f"[Scheduler] Error comparing history: {e}")
-                
-                # Save to History
-                database.add_history(job['url'], "Auto-CSS", data, status="scheduled_success")
-                
-                # 3. Send Email based on duplicate check
-                if is_duplicate:
-                    # No change - send "no update" email
-                    subject = "360d 通知: 今日無更新 (內容未變更)"
-                    mailer.send_notification_email(job['email'], subject, updates=[])
-                elif len(data) > 0:
-                    subject = f"360d 通知: 今日有更新 ({len(data)} 則)"
-                    mailer.send_notification_email(job['email'], subject, updates=data)
-                else:
-                    subject = "360d 通知: 今日無更新"
-                    mailer.send_notification_email(job['email'], subject, updates=[])
-
-            # 4. Handle one-time vs continuous scheduling
-            is_continuous = job.get('is_continuous', 1)  # Default to continuous
-            if is_continuous:
-                # Update Next Run for continuous scheduling
-                job_unit = job.get('unit', 'days')
-                database.update_schedule_next_run(job['id'], job['frequency_days'], unit=job_unit)
-            else:
-                # One-time scheduling - deactivate after running
-                database.toggle_schedule_active(job['id'], False)
-                print(f"[Scheduler] One-time job {job['id']} completed and deactivated.")
-            
-        except Exception as e:
-            print(f"Error processing job {job['id']}: {e}")
+        by_url.setdefault(job['url'], []).append(job)
+
+    futures = []
+    deferred = 0
+    now = utc_now()
+    with _state_lock:
+        for url, jobs in by_url.items():
+            jobs = [job for job in jobs if job['id'] not in _in_flight]
+            if not jobs:
+                continue
+            host = _host_of(url)
+            if _host_active.get(host, 0) >= MAX_JOBS_PER_HOST:
+                deferred += len(jobs)
+                _deferred.update(job['id'] for job in jobs)
+                continue
+            for job in jobs:
+                _in_flight.add(job['id'])
+                if job['next_run']:
+                    LAG_SECONDS.observe(max((now - parse_db_time(job['next_run'])).total_seconds(), 0))
+            _host_active[host] = _host_active.get(host, 0) + 1
+            futures.append(_executor.submit(_run_tracked, url, jobs, host))
+
+    if deferred:
+        DEFERRED_TOTAL.inc(deferred)
+        print(f"[Scheduler] Deferred {deferred} job(s) over the per-host limit of {MAX_JOBS_PER_HOST}.")
+
+    if wait:
+        for future in futures:
+            future.result()
+    return futures
+
+def _on_wakeup():
+    """Fires at the earliest next_run in the queue, runs what is due and re-arms."""
+    if _queue.pop_due():
+        check_and_run_jobs()
+    _arm()
+
+def _arm():
+    """Schedules the next wakeup exactly at the earliest queued next_run (or none when idle)."""
+    if not scheduler.running:
+        return
+    next_due = _queue.next_due()
+    if next_due is None:
+        if scheduler.get_job('master_job_check'):
+            scheduler.remove_job('master_job_check')
+        return
+    run_date = max(next_due.replace(tzinfo=timezone.utc), datetime.now(timezone.utc) + timedelta(milliseconds=10))
+    scheduler.add_job(_on_wakeup, 'date', run_date=run_date, id='master_job_check',
+                      replace_existing=True, misfire_grace_time=None)
+
+def reload_queue():
+    """Rebuilds the wakeup queue from the active schedules in the database."""
+    if not scheduler.running:
+        return
+    _queue.load(database.get_active_schedules())
+    with _state_lock:
+        # Running schedules are re-queued when they finish
+        for schedule_id in _in_flight | _deferred:
+            _queue.remove(schedule_id)
+    _arm()
+
+def schedule_updated(schedule_id: int):
+    """Syncs one schedule into the wakeup queue after it was created, paused or resumed."""
+    if not scheduler.running:
+        return
+    schedule = database.get_schedule(schedule_id)
+    with _state_lock:
+        running = schedule_id in _in_flight
+    if schedule and schedule['is_active'] and schedule['next_run'] and not running:
+        _queue.upsert(schedule_id, schedule['next_run'])
+    else:
+        _queue.remove(schedule_id)
+    _arm()
 
 def start_scheduler():
     """Starts the background scheduler if not already running."""
     if not scheduler.running:
         database.init_db() # Ensure DB exists
-        # Check every 3 seconds for near-instant response
-        scheduler.add_job(check_and_run_jobs, 'interval', seconds=3, id='master_job_check', replace_existing=True)
+        scheduler.add_job(reload_queue, 'interval', minutes=RESYNC_MINUTES, id='schedule_resync',
+                          replace_existing=True, max_instances=1, coalesce=True)
+        import retention
+        scheduler.add_job(retention.run, 'interval', minutes=retention.INTERVAL_MINUTES, id='history_retention',
+                          replace_existing=True, max_instances=1, coalesce=True)
         scheduler.start()
-        print("[Scheduler] Started - checking every 3 seconds")
+        reload_queue()
+        outbox.start()
+        print(f"[Scheduler] Started - {len(_queue)} active schedule(s) queued, waking at next due time ({MAX_WORKERS} workers, {MAX_JOBS_PER_HOST} per host)")
+
+def stop_scheduler():
+    """Stops the wakeups and periodic jobs; URL runs already dispatched finish in their worker threads."""
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+        print("[Scheduler] Stopped")
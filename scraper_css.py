@@ -1,84 +1,154 @@
-import requests
-from bs4 import BeautifulSoup
-import urllib3
+import os
+import time
 from typing import List, Dict, Tuple, Any
 
-# Suppress SSL warnings
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import charset_resolver
+import database
+import html_backend
+import http_client
+import metrics
+import selector_schema
+
+# Streaming fetch: stop downloading once the schema's containers have closed,
+# or once the byte budget is spent
+STREAMING = os.getenv("SCRAPER_STREAMING", "1") == "1"
+STREAM_CHUNK_SIZE = int(os.getenv("SCRAPER_STREAM_CHUNK_SIZE", "16384"))
+STREAM_MAX_BYTES = int(os.getenv("SCRAPER_STREAM_MAX_BYTES", str(4 * 1024 * 1024)))
+# After stopping early, a remainder up to this size is still read (and
+# discarded) so the keep-alive connection goes back to the pool; reading a
+# few more KB is cheaper than a new TCP/TLS handshake. Larger remainders, or
+# bodies without Content-Length, drop the connection instead.
+STREAM_DRAIN_MAX_BYTES = int(os.getenv("SCRAPER_STREAM_DRAIN_MAX_BYTES", str(128 * 1024)))
+
+FETCH_SECONDS = metrics.Histogram("scraper_fetch_seconds", "End-to-end CSS scraper fetch time", ["result"])
+STAGE_SECONDS = metrics.Histogram(
+    "scraper_stage_seconds", "CSS scraper time per stage (network, decode, parse, extract)", ["stage"]
+)
+
+def _read_body(response, compiled: selector_schema.CompiledSchema) -> bytes:
+    """
+    Reads a streamed response chunk by chunk, feeding an incremental tag
+    watcher, and stops as soon as all target containers have been closed.
+    """
+    groups = compiled.stream_groups
+    watcher = html_backend.ContainerWatcher(groups) if groups else None
+    chunks = []
+    size = 0
+    stopped_early = False
+    for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+        chunks.append(chunk)
+        size += len(chunk)
+        if watcher:
+            watcher.feed_bytes(chunk)
+            if watcher.done:
+                print(f"[CSS Scraper] Target containers complete after {size} bytes, stopping download.")
+                stopped_early = True
+                break
+        if size >= STREAM_MAX_BYTES:
+            print(f"[CSS Scraper] Byte budget of {STREAM_MAX_BYTES} reached, stopping download.")
+            stopped_early = True
+            break
+    if stopped_early:
+        _release(response)
+    return b"".join(chunks)
+
+def _release(response):
+    """
+    Gives the response's connection back to the pool, reading a small unread
+    remainder first (see STREAM_DRAIN_MAX_BYTES); otherwise the connection is
+    closed. Safe to call more than once.
+    """
+    raw = response.raw
+    remaining = getattr(raw, "length_remaining", None)
+    if remaining and remaining <= STREAM_DRAIN_MAX_BYTES:
+        raw.drain_conn()
+    if getattr(raw, "length_remaining", None) == 0:
+        raw.release_conn()
+    response.close()
 
 def fetch_data(url: str) -> Tuple[List[Dict[str, Any]], str]:
     """
-    Fetches data using traditional CSS selectors (BeautifulSoup).
-    Optimized for roccrane.org.tw.
+    Fetches data using traditional CSS selectors (BeautifulSoup), driven by
+    the declarative schema for the URL's domain (see selector_schema).
     Returns (Data List, Error Message).
     """
+    data, error, _ = fetch_data_conditional(url)
+    return data, error
+
+def fetch_data_conditional(url: str) -> Tuple[List[Dict[str, Any]], str, bool]:
+    """
+    Same as fetch_data, but revalidates against the cached ETag / Last-Modified.
+    On 304 Not Modified the cached result is returned without downloading or parsing.
+    Returns (Data List, Error Message, Not Modified).
+    """
+    start = time.perf_counter()
+    data, error, not_modified = _fetch_conditional(url)
+    result = "error" if error else ("not_modified" if not_modified else "ok")
+    FETCH_SECONDS.observe(time.perf_counter() - start, result=result)
+    return data, error, not_modified
+
+def _fetch_conditional(url: str) -> Tuple[List[Dict[str, Any]], str, bool]:
     print(f"[CSS Scraper] Fetching {url}...")
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-    }
     
     try:
-        response = requests.get(url, headers=headers, verify=False, timeout=15)
-        response.encoding = response.apparent_encoding or 'utf-8'
-        
-        if response.status_code != 200:
-            return [], f"HTTP Error {response.status_code}"
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        results = []
-        
-        # 1. Target: News Home Items
-        # Structure: .news-home__item -> .news-home__date, .news-home__heading
-        news_items = soup.select(".news-home__item")
-        
-        for item in news_items:
-            date_tag = item.select_one(".news-home__date")
-            date = date_tag.get_text(strip=True) if date_tag else "N/A"
-            
-            title_tag = item.select_one(".news-home__heading")
-            title = title_tag.get_text(strip=True) if title_tag else "No Title"
-            
-            link_tag = item.select_one(".news-home__heading-link")
-            link = link_tag['href'] if link_tag and link_tag.has_attr('href') else ""
-            if link and not link.startswith("http"):
-                link = requests.compat.urljoin(url, link)
-            
-            results.append({
-                "date": date,
-                "title": title,
-                "summary": title, # Use title as summary for CSS mode
-                "link": link,
-                "source": "CSS_Scraper"
-            })
-            
-        # 2. Target: Service/Course Cards (e.g. 即測即評)
-        # Structure: .card-service -> .card-service__date, .card-service__description
-        service_cards = soup.select(".card-service")
-        for card in service_cards:
-            date_tag = card.select_one(".card-service__date")
-            desc_tag = card.select_one(".card-service__description")
-            
-            if date_tag and desc_tag:
-                 date = date_tag.get_text(strip=True)
-                 title = desc_tag.get_text(strip=True)
-                 link_tag = card.select_one("a.card-service__learnmore")
-                 link = link_tag['href'] if link_tag and link_tag.has_attr('href') else url
-                 if link and not link.startswith("http"):
-                    link = requests.compat.urljoin(url, link)
+        compiled = selector_schema.get_compiled(selector_schema.schema_for_url(url))
+    except Exception as e:
+        return [], f"Schema Error: {str(e)}", False
+    
+    cached = None
+    try:
+        cached = database.get_fetch_cache(url)
+        # A cached result extracted with another schema version cannot be reused
+        if cached and cached['schema_hash'] != compiled.hash:
+            cached = None
+    except Exception as e:
+        print(f"[CSS Scraper] Fetch cache unavailable: {e}")
+    
+    headers = {}
+    if cached:
+        if cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+    
+    try:
+        with STAGE_SECONDS.time(stage="network"):
+            response = http_client.get(url, headers=headers, timeout=15, stream=STREAMING)
+            # A streamed response holds its pool slot until released, whichever way this ends
+            try:
+                if response.status_code == 304 and cached:
+                    print(f"[CSS Scraper] Not modified, reusing {len(cached['data'])} cached items.")
+                    return cached['data'], None, True
+
+                if response.status_code != 200:
+                    return [], f"HTTP Error {response.status_code}", False
 
-                 results.append({
-                    "date": date,
-                    "title": f"[Service] {title}",
-                    "summary": title,
-                    "link": link,
-                    "source": "CSS_Scraper"
-                 })
+                body = _read_body(response, compiled) if STREAMING else response.content
+            finally:
+                _release(response)
+
+        with STAGE_SECONDS.time(stage="decode"):
+            # Declared charset first, detection only when missing or wrong (cached per host)
+            text, _ = charset_resolver.decode(url, response.headers, body)
+        
+        with STAGE_SECONDS.time(stage="parse"):
+            soup = html_backend.parse(text, containers=compiled.container_classes)
+        with STAGE_SECONDS.time(stage="extract"):
+            results = selector_schema.extract(soup, compiled, url)
 
         if not results:
-             return [], "No items found with current CSS selectors."
+             return [], "No items found with current CSS selectors.", False
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            try:
+                database.save_fetch_cache(url, etag, last_modified, results, schema_hash=compiled.hash)
+            except Exception as e:
+                print(f"[CSS Scraper] Failed to update fetch cache: {e}")
 
         print(f"[CSS Scraper] Successfully extracted {len(results)} items.")
-        return results, None
+        return results, None, False
 
     except Exception as e:
-        return [], f"Scraping Error: {str(e)}"
+        return [], f"Scraping Error: {str(e)}", False
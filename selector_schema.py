@@ -0,0 +1,222 @@
+"""
+Declarative CSS extraction schemas.
+
+A schema lists containers, each with a baseSelector, the fields read from
+inside every matched container and an output template per result key
+(similar to the JsonCssExtractionStrategy schemas in crawl4ai):
+
+    {"name": "...", "containers": [{
+        "baseSelector": ".news-home__item",
+        "fields": [{"name": "title", "selector": ".heading", "type": "text", "default": "No Title"},
+                   {"name": "link", "selector": "a", "type": "attribute", "attribute": "href",
+                    "absolute": true, "default": "{url}"},
+                   {"name": "date", "selector": ".date", "type": "text", "required": true}],
+        "output": {"title": "{title}", "link": "{link}", "source": "CSS_Scraper"}}]}
+
+Field types are "text" (stripped text) and "attribute". A missing element
+falls back to "default" ("{url}" is the page URL); a missing "required"
+element skips the whole container. Output values are str.format templates
+over the field values and {url}. An optional container "closedBy" names the
+class of the ancestor that encloses all of its matches; streaming fetches stop
+once it has closed (default: the container's parent element).
+
+Schemas are stored per domain as SCHEMA_DIR/<host>.json (the host with and
+without "www." is tried), falling back to SCHEMA_DIR/default.json.
+Compiled schemas are kept in an LRU keyed by schema hash; a schema dict seen
+before (schema_for_url returns the same dict until its file changes) is found
+by identity without hashing it again, so schema dicts must not be mutated.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from urllib.parse import urljoin, urlparse
+
+import soupsieve
+
+SCHEMA_DIR = os.getenv("SCHEMA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "schemas"))
+SCHEMA_CACHE_SIZE = int(os.getenv("SCHEMA_CACHE_SIZE", "64"))
+
+_SIMPLE_CLASS_SELECTOR = re.compile(r"^\.([A-Za-z0-9_-]+)$")
+
+
+class SchemaError(ValueError):
+    """The schema is malformed or contains an invalid selector."""
+
+
+def schema_hash(schema: Dict[str, Any]) -> str:
+    canonical = json.dumps(schema, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class CompiledSchema:
+    """A schema with every selector compiled once by soupsieve."""
+
+    def __init__(self, schema: Dict[str, Any]):
+        self.name = schema.get("name", "unnamed")
+        self.hash = schema_hash(schema)
+        self.containers = []
+        try:
+            for container in schema["containers"]:
+                fields = []
+                for field in container["fields"]:
+                    fields.append({
+                        "name": field["name"],
+                        "selector": soupsieve.compile(field["selector"]),
+                        "type": field.get("type", "text"),
+                        "attribute": field.get("attribute"),
+                        "absolute": field.get("absolute", False),
+                        "default": field.get("default", ""),
+                        "required": field.get("required", False),
+                    })
+                self.containers.append({
+                    "base": soupsieve.compile(container["baseSelector"]),
+                    "base_selector": container["baseSelector"],
+                    "closed_by": container.get("closedBy"),
+                    "fields": fields,
+                    "output": container.get("output") or {f["name"]: "{" + f["name"] + "}" for f in fields},
+                })
+        except (KeyError, TypeError) as e:
+            raise SchemaError(f"Invalid schema '{self.name}': missing {e}")
+        except soupsieve.SelectorSyntaxError as e:
+            raise SchemaError(f"Invalid selector in schema '{self.name}': {e}")
+
+    @property
+    def container_classes(self) -> Optional[List[str]]:
+        """
+        Class names for scoped parsing (html_backend.parse), or None when a
+        baseSelector is more than a single class and the full page is needed.
+        """
+        classes = []
+        for container in self.containers:
+            match = _SIMPLE_CLASS_SELECTOR.match(container["base_selector"].strip())
+            if not match:
+                return None
+            classes.append(match.group(1))
+        return classes
+
+    @property
+    def stream_groups(self) -> Optional[Dict[str, Optional[str]]]:
+        """Container class -> closing ancestor class, for html_backend.ContainerWatcher."""
+        classes = self.container_classes
+        if classes is None:
+            return None
+        return {name: container["closed_by"] for name, container in zip(classes, self.containers)}
+
+
+_compiled: "OrderedDict[str, CompiledSchema]" = OrderedDict()
+# id(schema dict) -> (the dict, its compiled form); holding the dict keeps its id from being reused
+_by_identity: "OrderedDict[int, tuple]" = OrderedDict()
+_compiled_lock = threading.Lock()
+
+
+def get_compiled(schema: Dict[str, Any]) -> CompiledSchema:
+    """Returns the compiled form of a schema, compiling it at most once per LRU lifetime."""
+    with _compiled_lock:
+        seen = _by_identity.get(id(schema))
+        if seen is not None and seen[0] is schema:
+            _by_identity.move_to_end(id(schema))
+            return seen[1]
+    key = schema_hash(schema)
+    with _compiled_lock:
+        compiled = _compiled.get(key)
+        if compiled is not None:
+            _compiled.move_to_end(key)
+    if compiled is None:
+        compiled = CompiledSchema(schema)
+    with _compiled_lock:
+        _compiled[key] = compiled
+        while len(_compiled) > SCHEMA_CACHE_SIZE:
+            _compiled.popitem(last=False)
+        _by_identity[id(schema)] = (schema, compiled)
+        while len(_by_identity) > SCHEMA_CACHE_SIZE:
+            _by_identity.popitem(last=False)
+    return compiled
+
+
+_files: Dict[str, Any] = {}
+_files_lock = threading.Lock()
+
+
+def _load_file(path: str) -> Optional[Dict[str, Any]]:
+    """Reads a schema file, re-reading it only when its mtime changes."""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    with _files_lock:
+        cached = _files.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+    with open(path, encoding="utf-8") as f:
+        schema = json.load(f)
+    with _files_lock:
+        _files[path] = (mtime, schema)
+    return schema
+
+
+def clear_cache():
+    """Drops compiled schemas and cached schema files (they are rebuilt on next use)."""
+    with _compiled_lock:
+        _compiled.clear()
+        _by_identity.clear()
+    with _files_lock:
+        _files.clear()
+
+
+def schema_for_url(url: str) -> Dict[str, Any]:
+    """Looks up the schema for a URL's domain, falling back to default.json."""
+    host = urlparse(url).hostname or ""
+    candidates = [host]
+    if host.startswith("www."):
+        candidates.append(host[4:])
+    else:
+        candidates.append(f"www.{host}")
+    candidates.append("default")
+    for name in candidates:
+        if not name:
+            continue
+        schema = _load_file(os.path.join(SCHEMA_DIR, f"{name}.json"))
+        if schema is not None:
+            return schema
+    raise SchemaError(f"No extraction schema for {host} and no default.json in {SCHEMA_DIR}")
+
+
+def _field_value(node, field: Dict[str, Any], page_url: str) -> Optional[str]:
+    tag = field["selector"].select_one(node)
+    value = None
+    if tag is not None:
+        if field["type"] == "attribute":
+            value = tag.get(field["attribute"])
+            if isinstance(value, list):
+                value = " ".join(value)
+        else:
+            value = tag.get_text(strip=True)
+    elif field["required"]:
+        return None
+
+    if value is None:
+        value = field["default"].replace("{url}", page_url) if isinstance(field["default"], str) else field["default"]
+    if field["absolute"] and value and not value.startswith("http"):
+        value = urljoin(page_url, value)
+    return value
+
+
+def extract(soup, compiled: CompiledSchema, page_url: str) -> List[Dict[str, Any]]:
+    """Applies a compiled schema to a parsed page and returns the result dicts, container by container."""
+    results = []
+    for container in compiled.containers:
+        for node in container["base"].select(soup):
+            values = {"url": page_url}
+            for field in container["fields"]:
+                value = _field_value(node, field, page_url)
+                if value is None:
+                    break
+                values[field["name"]] = value
+            else:
+                results.append({key: template.format_map(values) if isinstance(template, str) else template
+                                for key, template in container["output"].items()})
+    return results
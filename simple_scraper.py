@@ -1,71 +1,52 @@
-import requests
-from bs4 import BeautifulSoup
 import json
-import urllib3
 
-# Suppress SSL warnings
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import charset_resolver
+import html_backend
+import http_client
+import selector_schema
+
+# Same targets as scraper_css, with this script's own output shape
+SCHEMA = {
+    "name": "simple-scraper",
+    "containers": [
+        {
+            # News Home Items: .news-home__item -> .news-home__date, .news-home__heading
+            "baseSelector": ".news-home__item",
+            "fields": [
+                {"name": "date", "selector": ".news-home__date", "type": "text", "default": "N/A"},
+                {"name": "title", "selector": ".news-home__heading", "type": "text", "default": "No Title"},
+                {"name": "link", "selector": ".news-home__heading-link", "type": "attribute", "attribute": "href", "absolute": True, "default": ""},
+            ],
+            "output": {"date": "{date}", "title": "{title}", "link": "{link}", "summary": "Extracted via CSS Selector"},
+        },
+        {
+            # Service Cards with dates (e.g. 即測即評); card links vary, so link to the page
+            "baseSelector": ".card-service",
+            "fields": [
+                {"name": "date", "selector": ".card-service__date", "type": "text", "required": True},
+                {"name": "description", "selector": ".card-service__description", "type": "text", "required": True},
+            ],
+            "output": {"date": "{date}", "title": "[Service/Card] {description}", "link": "{url}", "summary": "Service Card Item"},
+        },
+    ],
+}
 
 def scrape_traditionally(url):
     print(f"Fetching {url}...")
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-    }
     
     try:
-        response = requests.get(url, headers=headers, verify=False, timeout=15)
-        response.encoding = response.apparent_encoding or 'utf-8'
+        response = http_client.get(url, timeout=15)
         
         if response.status_code != 200:
             return {"error": f"HTTP {response.status_code}"}
         
-        soup = BeautifulSoup(response.text, 'html.parser')
-        results = []
-        
-        # Target: News Home Items
-        # Based on inspection: .news-home__item -> .news-home__date, .news-home__heading
-        news_items = soup.select(".news-home__item")
-        print(f"Found {len(news_items)} news items.")
+        # Decoded once, with the resolved charset (response.text would guess again)
+        text, _ = charset_resolver.decode(url, response.headers, response.content)
+        compiled = selector_schema.get_compiled(SCHEMA)
+        soup = html_backend.parse(text, containers=compiled.container_classes)
+        results = selector_schema.extract(soup, compiled, url)
+        print(f"Found {len(results)} items.")
         
-        for item in news_items:
-            # Extract Date
-            date_tag = item.select_one(".news-home__date")
-            date = date_tag.get_text(strip=True) if date_tag else "N/A"
-            
-            # Extract Title
-            title_tag = item.select_one(".news-home__heading")
-            title = title_tag.get_text(strip=True) if title_tag else "No Title"
-            
-            # Extract Link
-            link_tag = item.select_one(".news-home__heading-link")
-            link = link_tag['href'] if link_tag and link_tag.has_attr('href') else ""
-            if link and not link.startswith("http"):
-                link = requests.compat.urljoin(url, link)
-            
-            results.append({
-                "date": date,
-                "title": title,
-                "link": link,
-                "summary": "Extracted via CSS Selector"
-            })
-            
-        # Fallback/Additional: Service Cards with dates (e.g. 即測即評)
-        service_cards = soup.select(".card-service")
-        for card in service_cards:
-            date_tag = card.select_one(".card-service__date")
-            desc_tag = card.select_one(".card-service__description")
-            
-            if date_tag and desc_tag:
-                 date = date_tag.get_text(strip=True)
-                 title = desc_tag.get_text(strip=True)
-                 # Clean up date if it has extra text
-                 results.append({
-                    "date": date,
-                    "title": f"[Service/Card] {title}",
-                    "link": url, # Card links vary, simplify for now
-                    "summary": "Service Card Item"
-                 })
-
         return results
 
     except Exception as e: